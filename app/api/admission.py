@@ -0,0 +1,81 @@
+import threading
+import time
+
+# Ограничение одновременных запросов перед БД: на пике лишние запросы ждут в короткой очереди,
+# а если очередь полна или ждать пришлось дольше timeout - сразу получают 503 с Retry-After.
+# Лимиты отдельные для чтений и записей, чтоб поток записей не выедал соединения у чтений
+
+
+class AdmissionLimiter:
+    def __init__(self, limit, max_queue=0, timeout=1.0):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = {'queue_full': 0, 'timeout': 0}
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        # True - можно выполнять запрос (потом обязательно release), иначе причина отказа
+        with self._condition:
+            # Пока кто-то ждет, новые запросы встают в очередь за ним, а не проскакивают вперед
+            if self.active < self.limit and self.waiting == 0:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected['queue_full'] += 1
+                return 'queue_full'
+            self.waiting += 1
+            deadline = time.monotonic() + self.timeout
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected['timeout'] += 1
+                        return 'timeout'
+                    self._condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {'active': self.active, 'waiting': self.waiting, 'limit': self.limit, **self.rejected}
+
+
+def load_admission_limiters(config):
+    # ADMISSION = 0 - без ограничений. Для каждого класса (READ, WRITE):
+    #   ADMISSION_READ_LIMIT - сколько запросов выполняется одновременно,
+    #   ADMISSION_READ_QUEUE - сколько еще может ждать, ADMISSION_READ_TIMEOUT - сколько секунд ждать.
+    # Допущенный запрос должен сразу получить соединение: иначе он встанет в очередь пула (pool_timeout)
+    # мимо ограничителя. Поэтому по умолчанию лимиты делят пул DB_POOL_SIZE + DB_MAX_OVERFLOW (треть на записи),
+    # а лимиты больше пула не принимаются. Очередь по умолчанию - 4 лимита
+    if config.get('ADMISSION', '1') != '1':
+        return None
+    pool_connections = int(config.get('DB_POOL_SIZE', 5)) + int(config.get('DB_MAX_OVERFLOW', 10))
+    write_limit = max(1, pool_connections // 3)
+    defaults = {'read': (pool_connections - write_limit, 1.0), 'write': (write_limit, 2.0)}
+    limiters = dict()
+    for name, (limit, timeout) in defaults.items():
+        prefix = f'ADMISSION_{name.upper()}'
+        limit = int(config.get(f'{prefix}_LIMIT', limit))
+        limiters[name] = AdmissionLimiter(
+            limit=limit,
+            max_queue=int(config.get(f'{prefix}_QUEUE', limit * 4)),
+            timeout=float(config.get(f'{prefix}_TIMEOUT', timeout))
+        )
+    if min(limiter.limit for limiter in limiters.values()) < 1:
+        raise ValueError(f'ADMISSION_READ_LIMIT and ADMISSION_WRITE_LIMIT must be positive, the pool has '
+                         f'{pool_connections} connections (DB_POOL_SIZE + DB_MAX_OVERFLOW)')
+    total = sum(limiter.limit for limiter in limiters.values())
+    if total > pool_connections:
+        raise ValueError(f'ADMISSION_READ_LIMIT + ADMISSION_WRITE_LIMIT = {total} is more than the '
+                         f'{pool_connections} connections of DB_POOL_SIZE + DB_MAX_OVERFLOW')
+    return limiters
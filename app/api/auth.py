@@ -0,0 +1,61 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+def load_api_users(config):
+    # API_USERS = admin:password1,reader:password2
+    # Если API_USERS в конфиге нет, как и раньше пускаем только admin с паролем BASIC_PASSWORD
+    api_users = config.get('API_USERS')
+    if not api_users:
+        return {'admin': generate_password_hash(f"{config['BASIC_PASSWORD']}")}
+    users = dict()
+    for pair in api_users.split(','):
+        username, password = pair.strip().split(':', 1)
+        users[username] = generate_password_hash(password)
+    return users
+
+
+class CredentialCache:
+    # Кэш успешных проверок basic auth, чтоб не гонять PBKDF2 на каждый запрос.
+    # Пароль в кэше не хранится: только HMAC от него на случайном ключе процесса
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._key = os.urandom(32)
+        self._entries = OrderedDict()  # username -> (digest, хэш из конфига, время протухания)
+        self._lock = threading.Lock()
+
+    def _digest(self, password):
+        return hmac.new(self._key, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def verify(self, users, username, password):
+        password_hash = users.get(username)
+        if password_hash is None or password is None:
+            return False
+        digest = self._digest(password)
+
+        with self._lock:
+            entry = self._entries.get(username)
+        # Запись годится, только если пароль в конфиге с тех пор не менялся
+        if entry is not None and entry[1] == password_hash and entry[2] > time.monotonic():
+            if hmac.compare_digest(entry[0], digest):
+                return True
+
+        if not check_password_hash(password_hash, password):
+            return False
+        with self._lock:
+            self._entries[username] = (digest, password_hash, time.monotonic() + self.ttl)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
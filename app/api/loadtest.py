@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid as uuid_lib
+
+import requests
+
+# Нагрузочный прогон Server: поднимает сервер, заливает пользователей и гоняет смесь запросов
+# в несколько потоков. Пишет в JSON пропускную способность и p50/p95/p99 по каждому эндпоинту,
+# умеет сравнивать прогон с прошлым и падать с кодом 1 на регрессии.
+#   python -m app.api.loadtest --users=10000 --concurrency=16 --duration=30 --output=run.json
+#   python -m app.api.loadtest --output=new.json --compare=run.json --threshold=10
+# По умолчанию база - временный файл SQLite (для CI). Для MySQL (например из docker-compose)
+# передается свой конфиг сервера: --config=./app/api/config.txt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_MIX = 'get_user_info=6,edit_user_info=2,add_user=1,home=1'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_config(path, port, password, db_url):
+    config = {
+        'SERVER_HOST': '127.0.0.1',
+        'SERVER_PORT': port,
+        'DB_HOST': 'localhost',
+        'DB_PORT': 3306,
+        'DB_USER': 'root',
+        'DB_PASSWORD': '',
+        'DB_NAME': 'loadtest',
+        'DB_URL': db_url,
+        'BASIC_PASSWORD': password
+    }
+    with open(path, 'w') as config_file:
+        config_file.write(''.join(f'{key} = {value}\n' for key, value in config.items()))
+
+
+def start_server(config_path, base_url, log_path, auth, timeout=60):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    log_file = open(log_path, 'w')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'app', 'api', 'server.py'), f'--config={config_path}'],
+        cwd=os.path.dirname(log_path), env=env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'server exited with code {process.returncode}, see {log_path}')
+        try:
+            if requests.get(f'{base_url}/home', auth=auth, timeout=1).status_code == 200:
+                return process
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'server did not start in {timeout}s, see {log_path}')
+
+
+def new_user():
+    value = uuid_lib.uuid4()
+    return {
+        'uuid': str(value),
+        'username': f'user_{value.hex[:20]}',
+        'email': f'{value.hex[:20]}@example.com',
+        'phone': f'+{value.int % 10 ** 15}',
+        'gender': random.choice(['m', 'f']),
+        'gender_search': random.choice(['m', 'f']),
+        'balance': random.randint(0, 1000),
+        'birthday': f'{random.randint(1960, 2005)}-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}'
+    }
+
+
+def seed(base_url, auth, count, batch_size=5000):
+    uuids = []
+    for start in range(0, count, batch_size):
+        users = [new_user() for _ in range(min(batch_size, count - start))]
+        body = '\n'.join(json.dumps(user) for user in users)
+        report = requests.post(f'{base_url}/add_users', data=body, auth=auth).json()
+        failed = {error['row'] for error in report['errors']}
+        uuids.extend(user['uuid'] for row, user in enumerate(users) if row not in failed)
+    return uuids
+
+
+def parse_mix(mix):
+    weights = dict()
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+class Worker(threading.Thread):
+    def __init__(self, base_url, auth, uuids, weights, deadline, results, lock):
+        super().__init__(daemon=True)
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.uuids = uuids
+        self.names = list(weights)
+        self.weights = list(weights.values())
+        self.deadline = deadline
+        self.results = results
+        self.lock = lock
+
+    def request(self, name):
+        if name == 'home':
+            return self.session.get(f'{self.base_url}/home')
+        if name == 'add_user':
+            return self.session.post(f'{self.base_url}/add_user', json=new_user())
+        uuid = random.choice(self.uuids)
+        if name == 'get_user_info':
+            return self.session.get(f'{self.base_url}/get_user_info/{uuid}')
+        if name == 'edit_user_info':
+            return self.session.post(f'{self.base_url}/edit_user_info/{uuid}',
+                                     json={'new_balance': random.randint(0, 1000)})
+        raise ValueError(f'unknown endpoint {name}')
+
+    def run(self):
+        local = {name: {'latencies': [], 'errors': 0} for name in self.names}
+        while time.monotonic() < self.deadline:
+            name = random.choices(self.names, self.weights)[0]
+            started = time.perf_counter()
+            try:
+                ok = self.request(name).status_code < 400
+            except requests.RequestException:
+                ok = False
+            local[name]['latencies'].append((time.perf_counter() - started) * 1000)
+            local[name]['errors'] += not ok
+        with self.lock:
+            for name, result in local.items():
+                self.results[name]['latencies'].extend(result['latencies'])
+                self.results[name]['errors'] += result['errors']
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * percent / 100))], 3)
+
+
+def summarize(results, duration):
+    summary = dict()
+    for name, result in results.items():
+        latencies = sorted(result['latencies'])
+        summary[name] = {
+            'requests': len(latencies),
+            'errors': result['errors'],
+            'throughput_rps': round(len(latencies) / duration, 2),
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99)
+        }
+    return summary
+
+
+def compare(baseline, current, threshold):
+    # Регрессия: p95 вырос или пропускная способность упала больше чем на threshold процентов
+    regressions = []
+    for name, new in current['endpoints'].items():
+        old = baseline['endpoints'].get(name)
+        if not old or not old['requests'] or not new['requests']:
+            continue
+        if old['p95_ms'] and new['p95_ms'] > old['p95_ms'] * (1 + threshold / 100):
+            regressions.append(f'{name}: p95 {old["p95_ms"]}ms -> {new["p95_ms"]}ms')
+        if new['throughput_rps'] < old['throughput_rps'] * (1 - threshold / 100):
+            regressions.append(f'{name}: throughput {old["throughput_rps"]} -> {new["throughput_rps"]} rps')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, dest='config', help='конфиг сервера, по умолчанию SQLite во временной папке')
+    parser.add_argument('--users', type=int, dest='users', default=10000)
+    parser.add_argument('--concurrency', type=int, dest='concurrency', default=8)
+    parser.add_argument('--duration', type=float, dest='duration', default=30)
+    parser.add_argument('--mix', type=str, dest='mix', default=DEFAULT_MIX)
+    parser.add_argument('--output', type=str, dest='output', default='loadtest.json')
+    parser.add_argument('--compare', type=str, dest='compare')
+    parser.add_argument('--threshold', type=float, dest='threshold', default=10, help='допустимое ухудшение, %%')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='api_server_loadtest_')
+    if args.config:
+        from app.api.utils import config_parser
+        config_path = args.config
+        config = config_parser(config_path)
+        port = config['SERVER_PORT']
+        password = config['BASIC_PASSWORD']
+    else:
+        config_path = os.path.join(workdir, 'config.txt')
+        port = free_port()
+        password = uuid_lib.uuid4().hex
+        write_config(config_path, port, password, f'sqlite:///{os.path.join(workdir, "loadtest.db")}')
+    base_url = f'http://127.0.0.1:{port}'
+    auth = ('admin', password)
+    weights = parse_mix(args.mix)
+
+    server = start_server(config_path, base_url, os.path.join(workdir, 'server.log'), auth)
+    try:
+        seed_started = time.monotonic()
+        uuids = seed(base_url, auth, args.users)
+        seed_seconds = time.monotonic() - seed_started
+        print(f'seeded {len(uuids)} users in {seed_seconds:.1f}s')
+
+        results = {name: {'latencies': [], 'errors': 0} for name in weights}
+        lock = threading.Lock()
+        started = time.monotonic()
+        workers = [Worker(base_url, auth, uuids, weights, started + args.duration, results, lock)
+                   for _ in range(args.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        duration = time.monotonic() - started
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    report = {
+        'settings': {'users': len(uuids), 'concurrency': args.concurrency, 'duration': args.duration,
+                     'mix': weights, 'database': 'sqlite' if not args.config else 'config'},
+        'seed_seconds': round(seed_seconds, 2),
+        'endpoints': summarize(results, duration)
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    for name, summary in report['endpoints'].items():
+        print(f'{name}: {summary}')
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(json.load(baseline_file), report, args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
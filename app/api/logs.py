@@ -0,0 +1,71 @@
+import random
+import sys
+
+from loguru import logger
+
+# Единая настройка логов для сервера, вызывается один раз из server.py после чтения конфига.
+# Запись на диск идет из фонового потока (enqueue=True): запрос только кладет сообщение в очередь.
+# В prefork-режиме воркеры наследуют очередь мастера, файл пишет один процесс.
+#   LOG_FILE = log/api_server.log      LOG_FORMAT = json (или text)
+#   LOG_LEVEL = INFO                    LOG_LEVELS = app.db=WARNING,app.api.metrics=INFO
+#   LOG_SAMPLE = slow_request=10,bulk_retry=100   (писать одно сообщение из N)
+#   LOG_STDERR = 1                      LOG_ROTATION = 10 MB
+# Горячие места помечают сообщения ключом выборки: logger.bind(sample='slow_request').warning(...)
+
+TEXT_FORMAT = '{time} {level} {name} {message}'
+ERROR_LEVEL = logger.level('ERROR').no
+
+
+def parse_pairs(value):
+    # 'a=1,b=2' -> {'a': '1', 'b': '2'}
+    pairs = dict()
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        key, pair_value = item.split('=')
+        pairs[key.strip()] = pair_value.strip()
+    return pairs
+
+
+class LogFilter:
+    def __init__(self, level='INFO', module_levels=None, sample_rates=None):
+        self.level = logger.level(level.upper()).no
+        # Длинные префиксы первыми: app.db.interaction важнее app.db
+        self.module_levels = sorted(
+            ((module, logger.level(module_level.upper()).no) for module, module_level in (module_levels or {}).items()),
+            key=lambda item: len(item[0]), reverse=True
+        )
+        self.sample_rates = {key: int(rate) for key, rate in (sample_rates or {}).items()}
+
+    def module_level(self, name):
+        for module, level in self.module_levels:
+            if name == module or name.startswith(module + '.'):
+                return level
+        return self.level
+
+    def __call__(self, record):
+        if record['level'].no < self.module_level(record['name'] or ''):
+            return False
+        rate = self.sample_rates.get(record['extra'].get('sample'), 1)
+        # Ошибки не теряем при любой выборке
+        if rate > 1 and record['level'].no < ERROR_LEVEL:
+            return random.random() * rate < 1
+        return True
+
+
+def setup_logging(config):
+    log_filter = LogFilter(
+        level=config.get('LOG_LEVEL', 'INFO'),
+        module_levels=parse_pairs(config.get('LOG_LEVELS')),
+        sample_rates=parse_pairs(config.get('LOG_SAMPLE'))
+    )
+    serialize = config.get('LOG_FORMAT', 'json') == 'json'
+
+    logger.remove()
+    # diagnose=False: значения переменных из трейсбэков (пароли, данные пользователей) в лог не попадают
+    logger.add(config.get('LOG_FILE', 'log/api_server.log'), level=0, filter=log_filter, format=TEXT_FORMAT,
+               serialize=serialize, enqueue=True, diagnose=False,
+               rotation=config.get('LOG_ROTATION', '10 MB'), compression='zip')
+    if config.get('LOG_STDERR', '0') == '1':
+        logger.add(sys.stderr, level=0, filter=log_filter, enqueue=True, diagnose=False)
+    return log_filter
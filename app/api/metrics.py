@@ -0,0 +1,178 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_request_context, request
+from loguru import logger
+from sqlalchemy import event
+
+# Метрики запросов и SQL в формате Prometheus для /metrics.
+# Каждый процесс считает свое: в prefork-режиме значения относятся к воркеру, который ответил на /metrics
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+IN_LIST_RE = re.compile(r'\((?:\s*(?:%s|\?|%\(\w+\)s)\s*,)+\s*(?:%s|\?|%\(\w+\)s)\s*\)')
+VALUES_LIST_RE = re.compile(r'(VALUES\s*\([^)]*\))(?:\s*,\s*\([^)]*\))+', re.IGNORECASE)
+SPACES_RE = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    # Один и тот же запрос с разным числом параметров в IN (...) и VALUES (...), (...) - одна форма
+    shape = SPACES_RE.sub(' ', statement).strip()
+    shape = VALUES_LIST_RE.sub(r'\1, ...', shape)
+    shape = IN_LIST_RE.sub('(...)', shape)
+    return shape[:200]
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict()  # (имя, метки) -> значение
+        self.histograms = dict()  # (имя, метки) -> Histogram
+        self.gauges = dict()  # имя -> функция, возвращающая {метки: значение}
+        self.counter_callbacks = dict()  # то же для счетчиков, которые ведет кто-то другой
+        self.help = dict()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=(), buckets=LATENCY_BUCKETS):
+        with self._lock:
+            key = (name, labels)
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def gauge(self, name, callback):
+        self.gauges[name] = callback
+
+    def counter_callback(self, name, callback):
+        self.counter_callbacks[name] = callback
+
+    def render(self):
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f'# HELP {name} {self.help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.counts), h.sum, h.count, h.buckets) for key, h in histograms]
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), counts, total, count, buckets in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+        for kind, callbacks in (('counter', self.counter_callbacks), ('gauge', self.gauges)):
+            for name, callback in sorted(callbacks.items()):
+                header(name, kind)
+                for labels, value in callback().items():
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def instrument_app(app, metrics, slow_request_ms=None):
+    # Время, статус и число SQL-запросов на каждый HTTP-запрос. slow_request_ms - порог для лога медленных запросов
+    metrics.describe('http_requests_total', 'HTTP requests by endpoint, method and status')
+    metrics.describe('http_request_duration_seconds', 'HTTP request latency by endpoint')
+    metrics.describe('http_request_db_seconds', 'Time spent in SQL per HTTP request')
+    metrics.describe('http_request_db_queries', 'SQL statements per HTTP request')
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        g.metrics_queries = []
+
+    @app.after_request
+    def record_request(response):
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+        duration = time.perf_counter() - started
+        endpoint = request.endpoint or 'unknown'
+        queries = g.get('metrics_queries', [])
+        db_time = sum(query_duration for _, query_duration in queries)
+        metrics.inc('http_requests_total', (('endpoint', endpoint), ('method', request.method),
+                                            ('status', response.status_code)))
+        metrics.observe('http_request_duration_seconds', duration, (('endpoint', endpoint),))
+        metrics.observe('http_request_db_seconds', db_time, (('endpoint', endpoint),))
+        metrics.observe('http_request_db_queries', len(queries), (('endpoint', endpoint),), buckets=COUNT_BUCKETS)
+        if slow_request_ms is not None and duration * 1000 >= slow_request_ms:
+            statements = '; '.join(f'[{query_duration * 1000:.1f}ms] {statement}' for statement, query_duration in queries)
+            # Поля в extra попадают в JSON-лог отдельными ключами
+            slow_logger = logger.bind(sample='slow_request', endpoint=endpoint, duration_ms=round(duration * 1000, 1),
+                                      db_ms=round(db_time * 1000, 1), db_queries=len(queries))
+            slow_logger.warning(f'slow request {request.method} {request.path} {response.status_code} '
+                                f'{duration * 1000:.1f}ms, sql {db_time * 1000:.1f}ms in {len(queries)} queries: {statements}')
+        return response
+
+
+def instrument_engine(engine, metrics):
+    # Хуки на engine: время каждого запроса по форме SQL, плюс привязка к текущему HTTP-запросу
+    metrics.describe('db_queries_total', 'SQL statements by shape')
+    metrics.describe('db_query_duration_seconds', 'SQL statement latency by shape')
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['metrics_started'].pop()
+        shape = statement_shape(statement)
+        metrics.inc('db_queries_total', (('statement', shape),))
+        metrics.observe('db_query_duration_seconds', duration, (('statement', shape),))
+        if has_request_context() and 'metrics_queries' in g:
+            g.metrics_queries.append((shape, duration))
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        # Запрос упал, after_cursor_execute не будет
+        started = context.connection.info.get('metrics_started') if context.connection is not None else None
+        if started:
+            started.pop()
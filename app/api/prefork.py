@@ -0,0 +1,133 @@
+import os
+import signal
+import socket
+import threading
+import time
+
+from loguru import logger
+from werkzeug.serving import make_server
+
+from app.db.cache import LocalCacheBackend
+
+
+class PreforkServer:
+    # Продовый режим: мастер открывает слушающий сокет и форкает workers процессов,
+    # которые принимают соединения с общего сокета. Упавшие воркеры перезапускаются,
+    # по SIGTERM/SIGINT воркеры дообрабатывают текущие запросы и выходят
+    def __init__(self, server, host, port, workers=None, graceful_timeout=30):
+        self.server = server
+        self.host = host
+        self.port = int(port)
+        self.workers = workers or os.cpu_count() or 1
+        self.graceful_timeout = graceful_timeout
+        self.children = dict()  # pid -> время старта
+        self.stopping = False
+        self.socket = None
+
+    def listen(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(128)
+        sock.set_inheritable(True)
+        return sock
+
+    def run(self):
+        self.socket = self.listen()
+        # Соединения мастера не должны достаться воркерам: каждый откроет свой engine после форка
+        self.server.db_interaction.dispose()
+        self.check_user_cache()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logger.info(f'prefork master {os.getpid()} listening on {self.host}:{self.port}, workers: {self.workers}')
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            logger.error(f'worker {pid} exited with status {status}, restarting')
+            # Если воркер падает сразу после старта, не крутим форки в цикле
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+            self.spawn()
+
+        self.socket.close()
+        logger.info('prefork master stopped')
+
+    def check_user_cache(self):
+        # Локальный кэш у каждого воркера свой, а invalidate_user чистит только кэш воркера, сделавшего запись:
+        # остальные отдавали бы старый профиль (или 404 для нового uuid) до истечения TTL. Общий кэш - только redis
+        user_cache = self.server.db_interaction.user_cache
+        if self.workers > 1 and user_cache is not None and isinstance(user_cache.backend, LocalCacheBackend):
+            logger.warning(f'local user cache is not shared between {self.workers} workers, cache disabled: '
+                           f'use USER_CACHE_BACKEND = redis in prefork mode')
+            self.server.db_interaction.user_cache = None
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.monotonic()
+            return pid
+        # Дочерний процесс
+        exit_code = 0
+        try:
+            self.serve()
+        except Exception as e:
+            logger.exception(e)
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def serve(self):
+        # Обработчики мастера воркеру не нужны: Ctrl+C обрабатывает мастер, SIGTERM переопределяем ниже
+        self.children = dict()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        started = time.perf_counter()
+        self.server.db_interaction.reconnect()
+        http_server = make_server(self.host, self.port, self.server.app, threaded=True, fd=self.socket.fileno())
+        # При остановке ждем потоки с запросами, которые уже в работе
+        http_server.daemon_threads = False
+        http_server.block_on_close = True
+
+        def shutdown(signum, frame):
+            threading.Thread(target=http_server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        logger.info(f'worker {os.getpid()} started in {(time.perf_counter() - started) * 1000:.0f}ms')
+        http_server.serve_forever()
+        http_server.server_close()
+        self.server.db_interaction.dispose()
+        logger.info(f'worker {os.getpid()} stopped')
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            return
+        self.stopping = True
+        logger.info('prefork master stopping, draining workers')
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        threading.Thread(target=self.kill_after_timeout, daemon=True).start()
+
+    def kill_after_timeout(self):
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            time.sleep(0.1)
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
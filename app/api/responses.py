@@ -0,0 +1,85 @@
+import datetime
+import decimal
+import json
+import uuid
+import zlib
+
+from flask import Response, request
+
+# Ответы API в JSON. orjson из requirements.txt, без него (например, нет колеса под платформу) - стандартный json.
+# UUID - строкой, даты и время - в ISO 8601
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html')
+
+
+def default(value):
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(value):
+        return orjson.dumps(value, default=default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(value):
+        return json.dumps(value, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(value, status=200):
+    return Response(dumps(value), status=status, mimetype='application/json')
+
+
+def error_response(message, status=400, **fields):
+    # Ошибки тем же видом, что и у обработчика HTTPException: {"error": "..."}
+    return json_response({'error': message, **fields}, status)
+
+
+def conditional_json_response(value):
+    # Слабый ETag от тела ответа: у одинаковых данных он одинаковый и с gzip, и без.
+    # If-None-Match с тем же ETag получает 304 без тела
+    response = json_response(value)
+    response.add_etag(weak=True)
+    return response.make_conditional(request)
+
+
+def gzip_stream(chunks, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # 31 - формат gzip
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def enable_compression(app, min_size=1024, level=5):
+    # gzip для клиентов с Accept-Encoding: gzip. Обычные ответы - если тело не меньше min_size,
+    # потоковые (например /users) - всегда, сжимаются на лету по мере генерации
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code < 200 or response.status_code in (204, 206, 304)
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        response.vary.add('Accept-Encoding')
+        if not request.accept_encodings['gzip']:
+            return response
+        if response.is_streamed:
+            response.response = gzip_stream(response.iter_encoded(), level)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < min_size:
+                return response
+            response.set_data(b''.join(gzip_stream([data], level)))
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
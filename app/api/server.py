@@ -1,67 +1,238 @@
+import time
+
+# Отсчет времени старта процесса, включая импорты ниже
+started_at = time.perf_counter()
+
 import threading
-import requests
 import argparse
-from flask import Flask, request, jsonify
-from werkzeug.exceptions import abort
-from pymysql.err import IntegrityError
+from flask import Flask, Response, g, request, stream_with_context
+from werkzeug.exceptions import abort, HTTPException
+from sqlalchemy import exc
 from flask_httpauth import HTTPBasicAuth
-from app.api.utils import config_parser
-from app.db.exceptions import UserNotFoundException, OperationalErrorException
+from app.api.admission import load_admission_limiters
+from app.api.auth import load_api_users, CredentialCache
+from app.api.logs import setup_logging
+from app.api.metrics import Metrics, instrument_app, instrument_engine
+from app.api.prefork import PreforkServer
+from app.api.responses import dumps, json_response, error_response, conditional_json_response, enable_compression
+from app.api.utils import config_parser, iter_json_records, is_valid_uuid, parse_date
+from app.api.validation import validate_new_user, validate_user_changes, validate_balance_adjustment
+from app.db.exceptions import UserNotFoundException, OperationalErrorException, UserAlreadyExistsException, \
+    InsufficientBalanceException, IdempotencyKeyConflictException, BalanceOutOfRangeException
+from app.db.cache import make_user_cache
 from app.db.interaction.interaction import DBInteraction
-from werkzeug.security import generate_password_hash, check_password_hash
-import sys
 
 from loguru import logger
 
-logger.add(f'log/{__name__}.log', format='{time} {level} {message}', level='DEBUG', rotation='10 MB', compression='zip')
-
-# поднимаем парсер конфига
-parser = argparse.ArgumentParser()
-parser.add_argument('--config', type=str, dest='config')
-args = parser.parse_args()
-config = config_parser(args.config)
-# Вытаскиваем разрешенных пользователей
+# Конфиг, пользователи API и их хэши собираются в __main__, а не при импорте модуля
 auth = HTTPBasicAuth()
-basic_password = config['BASIC_PASSWORD']
-allow_api_users = {"admin": generate_password_hash(f"{basic_password}")}
+
+# Класс эндпоинта для ограничения одновременных запросов. Кого нет в списке (/home, /metrics, /cache_stats), не ограничиваем
+ENDPOINT_CLASSES = {
+    'get_user_info': 'read',
+    'get_users_info': 'read',
+    'list_users': 'read',
+    'get_stats': 'read',
+    'add_user': 'write',
+    'add_users': 'write',
+    'edit_user_info': 'write',
+    'adjust_balance': 'write',
+    'adjust_balances': 'write'
+}
+
+# Тексты ответов на нарушение уникальности, по имени колонки
+already_used_messages = {
+    'uuid': 'UUID already used',
+    'username': 'username already used',
+    'email': 'Email already used',
+    'phone': 'Phone already used'
+}
 
 
 class Server:
 
-    def __init__(self, host, port, db_host, db_port, user, password, db_name, rebuild_db=True):
+    def __init__(self, host, port, db_host, db_port, user, password, db_name, rebuild_db=False, optimistic_insert=True,
+                 bulk_batch_size=1000, db_pool=None, user_cache=None, max_page_size=10000, non_negative_balance=False,
+                 read_path='core', db_url=None, slow_request_ms=None, api_users=None, credential_cache=None,
+                 migrate_schema=True, compress_min_size=1024, compress_level=5, max_multi_get=1000, admission=None,
+                 retry_after=1, db_replicas=None, replica_options=None, stats_reconcile_interval=None,
+                 group_commit=None):
         self.host = host
         self.port = port
-
+        # Пользователи basic auth: {имя: хэш пароля} из load_api_users
+        self.api_users = api_users or dict()
+        self.credential_cache = credential_cache or CredentialCache()
+        auth.verify_password(self.verify_password)
+        # Не проверяем уникальность заранее, а ловим IntegrityError от уникальных ключей
+        self.optimistic_insert = optimistic_insert
+        # Сколько строк /add_users отправляет в БД одним multi-row INSERT
+        self.bulk_batch_size = bulk_batch_size
+        # Максимальный limit для /users
+        self.max_page_size = max_page_size
+        # Сколько uuid можно запросить за раз через /get_users_info
+        self.max_multi_get = max_multi_get
+        # Запрещать ли уход баланса в минус, если в запросе не сказано иначе
+        self.non_negative_balance = non_negative_balance
+        # {класс эндпоинта: AdmissionLimiter} из load_admission_limiters, None - без ограничений.
+        # retry_after - через сколько секунд отвергнутому клиенту стоит повторить
+        self.admission = admission
+        self.retry_after = retry_after
+
+        schema_started = time.perf_counter()
         self.db_interaction = DBInteraction(
             host=db_host,
             port=db_port,
             user=user,
             password=password,
             db_name=db_name,
-            rebuild_db=rebuild_db  # Это чтоб каждый раз работать с чистой базой
+            rebuild_db=rebuild_db,  # Снести все таблицы и начать с чистой базы (для разработки)
+            user_cache=user_cache,
+            read_path=read_path,
+            url=db_url,
+            migrate_schema=migrate_schema,  # Накатить недостающие миграции схемы
+            replicas=db_replicas,  # Реплики для чтений
+            replica_options=replica_options,
+            stats_reconcile_interval=stats_reconcile_interval,  # Сверка агрегатов /stats с таблицей users
+            group_commit=group_commit,  # Общий коммит для одновременных add_user и edit_user_info
+            **(db_pool or {})  # Настройки пула соединений
         )
+        # Длительность фаз старта в секундах, отдается в /metrics. imports и config дописывает __main__
+        self.startup_timings = {'schema': time.perf_counter() - schema_started}
 
         self.app = Flask(__name__)
 
+        # Метрики запросов и SQL, отдаются на /metrics
+        self.metrics = Metrics()
+        instrument_app(self.app, self.metrics, slow_request_ms=slow_request_ms)
+        for connection in self.db_interaction.connections():
+            connection.add_engine_hook(lambda engine: instrument_engine(engine, self.metrics))
+        self.metrics.gauge('user_cache', self.user_cache_metrics)
+        self.metrics.gauge('db_pool_connections', self.db_pool_metrics)
+        self.metrics.gauge('startup_seconds', self.startup_metrics)
+        self.metrics.gauge('admission_requests', self.admission_metrics)
+        self.metrics.describe('admission_rejected_total', 'Requests rejected with 503 by endpoint class and reason')
+        self.metrics.gauge('db_replica', self.replica_metrics)
+        self.metrics.counter_callback('db_read_routes_total', self.read_route_metrics)
+        self.metrics.describe('db_read_routes_total', 'Reads by target database and routing reason')
+        self.metrics.counter_callback('db_group_commit_total', self.group_commit_metrics)
+        self.metrics.gauge('user_stats_reconcile', self.stats_reconcile_metrics)
+        self.metrics.describe('user_stats_reconcile', 'Last user_stats reconcile run by this process and groups it corrected')
+        self.metrics.describe('db_group_commit_total', 'Group commit batches, writes in them and batches retried one by one')
+
 #        self.app.add_url_rule('/shutdown', view_func=self.shutdown)
         self.app.add_url_rule('/', view_func=self.get_home)
         self.app.add_url_rule('/home', view_func=self.get_home)
         self.app.add_url_rule('/add_user', view_func=self.add_user, methods=['POST'])
+        self.app.add_url_rule('/add_users', view_func=self.add_users, methods=['POST'])
         self.app.add_url_rule('/get_user_info/<uuid>', view_func=self.get_user_info)
+        self.app.add_url_rule('/get_users_info', view_func=self.get_users_info, methods=['POST'])
         self.app.add_url_rule('/edit_user_info/<uuid>', view_func=self.edit_user_info, methods=['POST'])
-
-        self.app.register_error_handler(404, self.page_not_found)
-
-    @auth.verify_password
-    def verify_password(username, password):
-        if username in allow_api_users and \
-                check_password_hash(allow_api_users.get(username), password):
+        self.app.add_url_rule('/users', view_func=self.list_users)
+        self.app.add_url_rule('/stats', view_func=self.get_stats)
+        self.app.add_url_rule('/adjust_balance/<uuid>', view_func=self.adjust_balance, methods=['POST'])
+        self.app.add_url_rule('/adjust_balances', view_func=self.adjust_balances, methods=['POST'])
+        self.app.add_url_rule('/cache_stats', view_func=self.get_cache_stats)
+        self.app.add_url_rule('/metrics', view_func=self.get_metrics)
+
+        # Все ошибки, в т.ч. abort(...) и 401 от basic auth, отдаются JSON вида {"error": "..."}
+        self.app.register_error_handler(HTTPException, self.http_error)
+        self.app.register_error_handler(exc.TimeoutError, self.db_pool_timeout)
+        auth.error_handler(self.unauthorized)
+        if compress_min_size is not None:
+            enable_compression(self.app, min_size=compress_min_size, level=compress_level)
+        # Сессия БД живет в пределах запроса
+        self.app.teardown_request(self.db_interaction.close_session)
+        if self.admission is not None:
+            self.app.before_request(self.admit_request)
+            # teardown вызывается и при исключении, и после отдачи потокового ответа
+            self.app.teardown_request(self.release_request)
+
+    def verify_password(self, username, password):
+        if self.credential_cache.verify(self.api_users, username, password):
             return username
 
-    def page_not_found(self, error_description):  # Кастомная ошибка 404
-        return jsonify(error=str(error_description)), 404
-
-    def runserver(self):
+    def admit_request(self):
+        limiter = self.admission.get(ENDPOINT_CLASSES.get(request.endpoint))
+        if limiter is None:
+            return None
+        admitted = limiter.acquire()
+        if admitted is not True:
+            endpoint_class = ENDPOINT_CLASSES[request.endpoint]
+            self.metrics.inc('admission_rejected_total', (('class', endpoint_class), ('reason', admitted)))
+            response = error_response('Server is overloaded, retry later', 503)
+            response.headers['Retry-After'] = str(self.retry_after)
+            return response
+        g.admission_limiter = limiter
+        return None
+
+    def db_pool_timeout(self, error):
+        # Соединение из пула не дождались за pool_timeout (пул заняли фоновые задачи или ADMISSION = 0):
+        # это перегрузка, как и отказ ограничителя, а не ошибка сервера
+        logger.warning(f'db pool timeout: {error}')
+        response = error_response('Server is overloaded, retry later', 503)
+        response.headers['Retry-After'] = str(self.retry_after)
+        return response
+
+    def release_request(self, exception=None):
+        limiter = g.pop('admission_limiter', None)
+        if limiter is not None:
+            limiter.release()
+
+    def replica_metrics(self):
+        router = self.db_interaction.router
+        if router is None:
+            return {}
+        values = dict()
+        for replica in router.stats()['replicas']:
+            values[(('replica', replica['name']), ('state', 'healthy'))] = int(replica['healthy'])
+            if replica['lag'] is not None:
+                values[(('replica', replica['name']), ('state', 'lag_seconds'))] = replica['lag']
+        return values
+
+    def read_route_metrics(self):
+        router = self.db_interaction.router
+        if router is None:
+            return {}
+        return {(('target', target), ('reason', reason)): count
+                for (target, reason), count in router.stats()['routes'].items()}
+
+    def stats_reconcile_metrics(self):
+        reconciler = self.db_interaction.stats_reconciler
+        if reconciler is None or reconciler.last_run is None:
+            return {}
+        return {(('state', 'last_run_timestamp'),): reconciler.last_run,
+                (('state', 'drift_groups'),): reconciler.last_drift}
+
+    def group_commit_metrics(self):
+        writer = self.db_interaction.group_commit
+        if writer is None:
+            return {}
+        stats = writer.stats()
+        return {(('kind', kind),): stats[kind] for kind in ('batches', 'writes', 'fallbacks')}
+
+    def admission_metrics(self):
+        if self.admission is None:
+            return {}
+        values = dict()
+        for endpoint_class, limiter in self.admission.items():
+            stats = limiter.stats()
+            for state in ('active', 'waiting', 'limit'):
+                values[(('class', endpoint_class), ('state', state))] = stats[state]
+        return values
+
+    def http_error(self, error):
+        return error_response(str(error), error.code)
+
+    def unauthorized(self, status=401):
+        return error_response('Unauthorized Access', status)
+
+    def runserver(self, mode='development', workers=None, graceful_timeout=30):
+        # development - встроенный сервер Flask в отдельном потоке,
+        # prefork - несколько процессов-воркеров на общем сокете (блокирует до остановки)
+        if mode == 'prefork':
+            self.server = PreforkServer(self, self.host, self.port, workers=workers, graceful_timeout=graceful_timeout)
+            self.server.run()
+            return self.server
         self.server = threading.Thread(target=self.app.run, kwargs={'host': self.host, 'port': self.port})
         self.server.start()
         return self.server
@@ -78,239 +249,293 @@ class Server:
 
     @auth.login_required
     def get_home(self):
-        return 'Hello from api server!'
-
-    @auth.login_required
-    def add_user(self):
-        request_body = dict(request.json)  # Берем тело из запроса
-        if request_body is None:
-            return 'request body is null', 400
-
-        # Try и except на случай, если какие-то необязательные параметры не были переданы
-        try:
-            uuid = request_body['uuid']
-            if uuid == '':
-                return 'UUID can not be null', 400
-            if uuid is not None:
-                check_uuid = self.db_interaction.check_uuid(uuid)
-                if check_uuid == 'UUID bad value':
-                    #logger.error(f'check_uuid" {check_uuid}')
-                    return 'UUID Type error', 400
-                elif check_uuid is True:
-                    return 'UUID already used', 400
-                #logger.info(f'uuid: {uuid}, uuid type: {type(uuid)}')
-                #logger.info(f'uuid bytes_size: {sys.getsizeof(uuid)}')
-        except KeyError:
-            return 'UUID id can be null', 400
-
-        try:
-            username = request_body['username']
-            if username == '':
-                username = None
-            if username is not None:
-                check_username = self.db_interaction.check_username(username)
-                if check_username is True:
-                    return f'username already used', 400
-        except KeyError:
-            username = None
+        return json_response({'message': 'Hello from api server!'})
 
-        try:
-            email = request_body['email']
-            if email == '':
-                email = None
-            #logger.info(f'email: {email}')
-            if email is not None:
-                check_email = self.db_interaction.check_email(email)
-                if check_email is True:
-                    return f'Email already used', 400
-        except KeyError:
-            email = None
+    def user_cache_metrics(self):
+        user_cache = self.db_interaction.user_cache
+        if user_cache is None:
+            return {}
+        return {(('stat', name),): value for name, value in user_cache.stats().items() if value is not None}
 
-        try:
-            phone = request_body['phone']
-            if phone == '':
-                phone = None
-            if phone is not None:
-                check_phone = self.db_interaction.check_phone(phone)
-                if check_phone is True:
-                    return 'Phone already used', 400
-        except KeyError:
-            phone = None
+    def db_pool_metrics(self):
+        pool = self.db_interaction.engine.pool
+        if not hasattr(pool, 'checkedout'):
+            return {}
+        return {(('state', 'checked_out'),): pool.checkedout(), (('state', 'checked_in'),): pool.checkedin()}
 
-        try:
-            gender = request_body['gender']
-            if gender == '':
-                return 'gender can not be null', 400
-        except KeyError:
-            return 'gender can not be null', 400
+    def startup_metrics(self):
+        return {(('phase', phase),): round(seconds, 4) for phase, seconds in self.startup_timings.items()}
 
-        try:
-            gender_search = request_body['gender_search']
-            if gender_search == '':
-                return 'gender_search can not be null', 400
-        except KeyError:
-            return 'gender_search can not be null', 400
+    @auth.login_required
+    def get_metrics(self):
+        return Response(self.metrics.render(), mimetype='text/plain; version=0.0.4')
 
-        try:
-            balance = request_body['balance']
-            if balance == '':
-                balance = 0
-        except KeyError:
-            balance = 0
+    @auth.login_required
+    def get_cache_stats(self):
+        user_cache = self.db_interaction.user_cache
+        if user_cache is None:
+            return json_response({'enabled': False})
+        return json_response({'enabled': True, **user_cache.stats()})
 
-        try:
-            birthday = request_body['birthday']
-            if birthday == '':
-                return 'birthday can not be null', 400
-        except KeyError:
-            return 'birthday can not be null', 400
-
-        # Валидируем параметры на соответствие требованиям sql
-        # Необязательные параметры
-        if username is not None and email is not None and phone is not None:
-            if len(username) > 50:
-                return f'username is more than 50 characters ', 400
-            elif len(email) > 40:
-                return f'email is more 40 characters', 400
-            elif len(phone) > 20:
-                return 'phone is more 20 characters', 400
-
-        #logger.info(f'check_username" {check_username}')
-        #logger.info(f'check_email: {check_email}')
-        #if sys.getsizeof(uuid) != 16:
-        #    return f'UUID must be 16 bytes string. Not {sys.getsizeof(uuid)}.'
+    @auth.login_required
+    def add_user(self):
+        # Берем тело из запроса. null, не-объект и битый JSON отсекает validate_new_user
+        request_body = request.get_json(silent=True)
+
+        user, error = validate_new_user(request_body)
+        if error is not None:
+            return error_response(error, 400)
+
+        # Проверки заранее нужны только без optimistic_insert, иначе дубли отсечет сама таблица
+        if not self.optimistic_insert:
+            check_uuid = self.db_interaction.check_uuid(user['uuid'])
+            if check_uuid == 'UUID bad value':
+                return error_response('UUID Type error', 400)
+            elif check_uuid is True:
+                return error_response('UUID already used', 400)
+            if user['username'] is not None and self.db_interaction.check_username(user['username']) is True:
+                return error_response('username already used', 400)
+            if user['email'] is not None and self.db_interaction.check_email(user['email']) is True:
+                return error_response('Email already used', 400)
+            if user['phone'] is not None and self.db_interaction.check_phone(user['phone']) is True:
+                return error_response('Phone already used', 400)
 
         try:
-            self.db_interaction.add_user(
-                uuid=uuid,
-                username=username,
-                email=email,
-                phone=phone,
-                gender=gender,
-                gender_search=gender_search,
-                balance=balance,
-                birthday=birthday
-            )
-            # Берем из БД объект user и возвращаем на запрос.
-            user = self.db_interaction.get_user_info(uuid)
-            return f'Success added User: {user}', 201  # Вместе с http status code
+            user = self.db_interaction.add_user(**user)
+            return json_response(user, 201)  # Вместе с http status code
+        except UserAlreadyExistsException as e:
+            return error_response(already_used_messages.get(e.field, f'{e.field} already used'), 400)
         except OperationalErrorException:
             abort(400, description='Bad request. Check types for parameters.')
 
+    @auth.login_required
+    def add_users(self):
+        # Массовая загрузка: тело читаем потоком (NDJSON или JSON-массив) и вставляем пачками
+        batch_size = request.args.get('batch_size', self.bulk_batch_size, type=int)
+        if batch_size < 1:
+            return error_response('batch_size must be a positive integer', 400)
+
+        report = {'inserted': 0, 'failed': 0, 'errors': []}
+
+        def fail(row, uuid, error):
+            report['failed'] += 1
+            report['errors'].append({'row': row, 'uuid': uuid, 'error': error})
+
+        def flush(batch):
+            results = self.db_interaction.add_users([user for _, user in batch])
+            for (row, user), result in zip(batch, results):
+                if result is None:
+                    report['inserted'] += 1
+                elif isinstance(result, UserAlreadyExistsException):
+                    fail(row, user['uuid'], already_used_messages.get(result.field, str(result)))
+                else:
+                    fail(row, user['uuid'], 'Bad request. Check types for parameters.')
+
+        batch = []
+        for row, (record, error) in enumerate(iter_json_records(request.stream)):
+            if error is None:
+                user, error = validate_new_user(record)
+            if error is not None:
+                fail(row, record.get('uuid') if isinstance(record, dict) else None, error)
+                continue
+            batch.append((row, user))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+
+        return json_response(report)
+
     @auth.login_required
     def get_user_info(self, uuid):
+        # Кривой UUID в базе точно не найдется, в БД за ним не ходим
+        if not is_valid_uuid(uuid):
+            abort(404, description='User not found')
         try:
-            #logger.info(f'username" {username}')
-            # Проверка UUID на наличие в базе
-            check_uuid = self.db_interaction.check_uuid(uuid)
-            # Возможно под это надо свой exception сделать
-            if check_uuid is False:
-                abort(404, description='User not found')
-
-            # Валидация
-            elif type(uuid) != str:
-                return f'Parameter UUID must be a string', 400
+            # Отдельный check_uuid не нужен: get_user_info сам бросит UserNotFoundException
             user_info = self.db_interaction.get_user_info(uuid)
-            return user_info
+            # ETag от содержимого: опрашивающий клиент без изменений получает 304 без тела
+            return conditional_json_response(user_info)
         except UserNotFoundException:
             abort(404, description='User not found')
 
     @auth.login_required
-    def edit_user_info(self, uuid):
-        # проверим есть ли такой username в базе
-        check_uuid = self.db_interaction.check_uuid(uuid)
-        #logger.info(f'check_uuid: {check_uuid}')
-        if check_uuid is False:
-            abort(404, description=f'UUID {uuid} not found')
-        try:
-            request_body = dict(request.json)  # Берем тело из запроса
-        except TypeError:
-            return 'Bad request body', 400
+    def get_users_info(self):
+        # Тело: {"uuids": [...]}. Ответ: {"users": {uuid: профиль}, "missing": [uuid, ...]}.
+        # Кривые uuid попадают в missing как есть, как и в get_user_info они просто не найдены
+        request_body = request.get_json(silent=True)
+        if not isinstance(request_body, dict) or not isinstance(request_body.get('uuids'), list):
+            return error_response('request body must contain uuids list', 400)
+        uuids = request_body['uuids']
+        if len(uuids) > self.max_multi_get:
+            return error_response(f'cannot request more than {self.max_multi_get} uuids', 400)
+
+        valid = []
+        missing = []
+        for uuid in uuids:
+            (valid if is_valid_uuid(uuid) else missing).append(uuid)
+        users = dict()
+        for uuid, user in self.db_interaction.get_users_info(valid).items():
+            if user is None:
+                missing.append(str(uuid))
+            else:
+                users[str(uuid)] = user
+        return json_response({'users': users, 'missing': missing})
 
+    @auth.login_required
+    def list_users(self):
+        # Страница пользователей после uuid из after. next_after из ответа передается в следующий запрос,
+        # null в next_after - страниц больше нет
+        after = request.args.get('after') or None
+        if after is not None and not is_valid_uuid(after):
+            return error_response('after must be a UUID', 400)
+        limit = request.args.get('limit', 100, type=int)
+        if not 0 < limit <= self.max_page_size:
+            return error_response(f'limit must be between 1 and {self.max_page_size}', 400)
         try:
-            new_username = request_body['new_username']
-            # сначала проверим на уникальность
-            check = self.db_interaction.check_username(new_username)
-            if check is True:
-                return f'new_username already used', 400
-            elif len(new_username) > 50:
-                return 'username cannot be more than 50 characters', 400
-            elif type(new_username) is not str:
-                return 'type parameter new_username must be a string', 400
-        except KeyError:
-            new_username = None
-            #logger.info(f'new_username: {new_username}')
+            birthday_from = parse_date(request.args.get('birthday_from'))
+            birthday_to = parse_date(request.args.get('birthday_to'))
+        except ValueError:
+            return error_response('birthday_from and birthday_to must be dates in YYYY-MM-DD format', 400)
+
+        users = self.db_interaction.iter_users(
+            after=after,
+            limit=limit,
+            gender=request.args.get('gender') or None,
+            gender_search=request.args.get('gender_search') or None,
+            birthday_from=birthday_from,
+            birthday_to=birthday_to
+        )
 
-        try:
-            new_email = request_body['new_email']
-            check = self.db_interaction.check_email(new_email)
-            if check is True:
-                return 'new_email already used', 400
-            elif len(new_email) > 20:
-                return 'new_email cannot be more than 20 characters', 400
-            elif type(new_email) is not str:
-                return 'type parameter new_email must be a string', 400
-        except KeyError:
-            new_email = None
+        def generate():
+            # JSON собираем кусками по мере чтения строк из курсора
+            yield b'{"users":['
+            count = 0
+            last_uuid = None
+            for user in users:
+                yield (b',' if count else b'') + dumps(user)
+                count += 1
+                last_uuid = user['uuid']
+            next_after = str(last_uuid) if count == limit else None
+            yield b'],"next_after":' + dumps(next_after) + b'}'
 
-        try:
-            new_phone = request_body['new_phone']
-            #logger.info(f'new_phone: {new_phone}')
-            check_phone = self.db_interaction.check_phone(new_phone)
-            if check_phone is True:
-                return 'new_phone already used', 400
-            elif len(new_phone) > 20:
-                return 'new_phone cannot be more than 20 characters', 400
-            elif type(new_phone) is not str:
-                return 'type new_phone must be a string', 400
-        except KeyError:
-            new_phone = None
+        return Response(stream_with_context(generate()), mimetype='application/json')
 
-        try:
-            new_gender = request_body['new_gender']
-            if len(new_gender) > 10:
-                return 'new_gender cannot be more than 10 characters'
-            elif type(new_gender) != str:
-                return 'new_gender must be a string', 400
-        except KeyError:
-            new_gender = None
+    @auth.login_required
+    def get_stats(self):
+        # Число пользователей, сумма и средний баланс, разбивка по полу и по когортам рождения
+        # из инкрементальных агрегатов user_stats. cohort_years - ширина когорты в годах
+        cohort_years = request.args.get('cohort_years', 10, type=int)
+        if cohort_years <= 0:
+            return error_response('cohort_years must be a positive integer', 400)
+        return json_response(self.db_interaction.get_stats(cohort_years=cohort_years))
 
+    @auth.login_required
+    def adjust_balance(self, uuid):
+        request_body = request.get_json(silent=True)
+        if isinstance(request_body, dict) and 'Idempotency-Key' in request.headers:
+            request_body.setdefault('idempotency_key', request.headers['Idempotency-Key'])
+        adjustment, error = validate_balance_adjustment(request_body, uuid=uuid)
+        if error is not None:
+            return error_response(error, 400)
+        non_negative = request_body.get('non_negative', self.non_negative_balance)
+        if type(non_negative) is not bool:
+            return error_response('non_negative must be a boolean', 400)
         try:
-            new_gender_search = request_body['new_gender_search']
-            if len(new_gender_search) > 10:
-                return 'new_gender_search cannot be more than 10 characters'
-            elif type(new_gender_search) != str:
-                return 'new_gender_search must be a string', 400
-        except KeyError:
-            new_gender_search = None
+            balance, applied = self.db_interaction.adjust_balance(
+                uuid=uuid,
+                delta=adjustment['delta'],
+                non_negative=non_negative,
+                idempotency_key=adjustment['idempotency_key']
+            )
+        except UserNotFoundException:
+            abort(404, description=f'UUID {uuid} not found')
+        except InsufficientBalanceException:
+            return error_response('Insufficient balance', 409)
+        except IdempotencyKeyConflictException:
+            return error_response('idempotency_key was already used with a different uuid or delta', 422)
+        except BalanceOutOfRangeException:
+            return error_response('Balance out of range', 409)
+        return json_response({'uuid': uuid, 'balance': balance, 'applied': applied})
 
+    @auth.login_required
+    def adjust_balances(self):
+        # Тело: {"adjustments": [{"uuid", "delta", "idempotency_key"}, ...], "non_negative": bool}
+        request_body = request.get_json(silent=True)
+        if not isinstance(request_body, dict) or not isinstance(request_body.get('adjustments'), list):
+            return error_response('request body must contain adjustments list', 400)
+        adjustments = []
+        for row, item in enumerate(request_body['adjustments']):
+            adjustment, error = validate_balance_adjustment(item)
+            if error is not None:
+                return error_response(error, 400, row=row)
+            adjustments.append(adjustment)
+        non_negative = request_body.get('non_negative', self.non_negative_balance)
+        if type(non_negative) is not bool:
+            return error_response('non_negative must be a boolean', 400)
         try:
-            new_balance = request_body['new_balance']
-            if type(new_balance) != int:
-                return 'new_gender_search must be a integer', 400
-        except KeyError:
-            new_balance = None
+            result = self.db_interaction.adjust_balances(adjustments, non_negative=non_negative)
+        except UserNotFoundException as e:
+            abort(404, description=str(e))
+        except InsufficientBalanceException as e:
+            return error_response('Insufficient balance', 409, uuids=e.uuids)
+        except BalanceOutOfRangeException as e:
+            return error_response('Balance out of range', 409, uuids=e.uuids)
+        except IdempotencyKeyConflictException as e:
+            return error_response('idempotency_key was already used with a different uuid or delta', 422,
+                                  idempotency_keys=e.keys)
+        except exc.IntegrityError:
+            # Те же idempotency_key одновременно применяет другая пачка: ничего не применили, можно повторить
+            return error_response('Concurrent batch with the same idempotency keys, retry', 409)
+        return json_response(result)
+
+    @auth.login_required
+    def edit_user_info(self, uuid):
+        if not is_valid_uuid(uuid):
+            abort(404, description=f'UUID {uuid} not found')
+        request_body = request.get_json(silent=True)  # Не объект - 'Bad request body' из validate_user_changes
 
+        # Сначала валидируем все поля, потом одним UPDATE пишем все сразу.
+        # Существование uuid и уникальность проверяет сам UPDATE
+        changes, error = validate_user_changes(request_body)
+        if error is not None:
+            return error_response(error, 400)
         try:
-            new_birthday = request_body['new_birthday']
-        except KeyError:
-            new_birthday = None
-
-        self.db_interaction.edit_user_info(
-            uuid=uuid,
-            new_username=new_username,
-            new_email=new_email,
-            new_phone=new_phone,
-            new_gender=new_gender,
-            new_gender_search=new_gender_search,
-            new_balance=new_balance,
-            new_birthday=new_birthday
-        )
-        new_user_info = self.get_user_info(uuid)
-        return f'Success edit user info: {new_user_info}', 200
+            new_user_info = self.db_interaction.edit_user_info(
+                uuid=uuid,
+                new_username=changes.get('username'),
+                new_email=changes.get('email'),
+                new_phone=changes.get('phone'),
+                new_gender=changes.get('gender'),
+                new_gender_search=changes.get('gender_search'),
+                new_balance=changes.get('balance'),
+                new_birthday=changes.get('birthday')
+            )
+        except UserNotFoundException:
+            abort(404, description=f'UUID {uuid} not found')
+        except UserAlreadyExistsException as e:
+            return error_response(f'new_{e.field} already used', 400)
+        except OperationalErrorException:
+            abort(400, description='Bad request. Check types for parameters.')
+        return json_response(new_user_info)
 
 
 if __name__ == '__main__':
+    imports_done = time.perf_counter()
+    # поднимаем парсер конфига
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, dest='config')
+    args = parser.parse_args()
+    config = config_parser(args.config)
+    setup_logging(config)
+    # Вытаскиваем разрешенных пользователей
+    allow_api_users = load_api_users(config)
+    credential_cache = CredentialCache(
+        max_size=int(config.get('AUTH_CACHE_SIZE', 1024)),
+        ttl=float(config.get('AUTH_CACHE_TTL', 300))
+    )
+    config_done = time.perf_counter()
 
     server_host = config['SERVER_HOST']
     server_port = config['SERVER_PORT']
@@ -319,6 +544,53 @@ if __name__ == '__main__':
     db_user = config['DB_USER']
     db_password = config['DB_PASSWORD']
     db_name = config['DB_NAME']
+    db_url = config.get('DB_URL')  # Если задан, используется вместо DB_HOST/DB_PORT/...
+    # Запросы дольше порога пишутся в лог вместе со списком SQL, по умолчанию выключено
+    slow_request_ms = float(config['SLOW_REQUEST_MS']) if config.get('SLOW_REQUEST_MS') else None
+
+    optimistic_insert = config.get('OPTIMISTIC_INSERT', '1') == '1'
+    bulk_batch_size = int(config.get('BULK_BATCH_SIZE', 1000))
+    max_page_size = int(config.get('MAX_PAGE_SIZE', 10000))
+    max_multi_get = int(config.get('MAX_MULTI_GET', 1000))
+    # Ограничение одновременных чтений и записей, см. app/api/admission.py
+    admission = load_admission_limiters(config)
+    retry_after = int(config.get('ADMISSION_RETRY_AFTER', 1))
+    non_negative_balance = config.get('BALANCE_NON_NEGATIVE', '0') == '1'
+    read_path = config.get('DB_READ_PATH', 'core')  # core или orm
+    rebuild_db = config.get('DB_REBUILD', '0') == '1'  # 1 - снести все таблицы на старте
+    migrate_schema = config.get('DB_MIGRATE', '1') == '1'  # 0 - миграции накатываются отдельно
+    # gzip для ответов от COMPRESS_MIN_SIZE байт, если клиент его принимает. COMPRESS = 0 - не сжимать
+    compress_min_size = int(config.get('COMPRESS_MIN_SIZE', 1024)) if config.get('COMPRESS', '1') == '1' else None
+    compress_level = int(config.get('COMPRESS_LEVEL', 5))
+    # В prefork с несколькими воркерами local отключается: у каждого воркера был бы свой кэш
+    user_cache = make_user_cache(
+        backend=config.get('USER_CACHE_BACKEND', 'local'),  # local, redis или off
+        max_size=int(config.get('USER_CACHE_SIZE', 10000)),
+        ttl=float(config.get('USER_CACHE_TTL', 60)),
+        negative_ttl=float(config.get('USER_CACHE_NEGATIVE_TTL', 5)),
+        redis_url=config.get('USER_CACHE_REDIS_URL')
+    )
+    # Реплики для чтений: DB_REPLICAS = host1:3306,host2:3306 (или строки подключения), пусто - все на мастер
+    db_replicas = [replica.strip() for replica in config.get('DB_REPLICAS', '').split(',') if replica.strip()]
+    replica_options = {
+        'max_lag': float(config.get('DB_REPLICA_MAX_LAG', 5)),
+        'check_interval': float(config.get('DB_REPLICA_CHECK_INTERVAL', 5)),
+        'sticky_seconds': float(config['DB_REPLICA_STICKY']) if config.get('DB_REPLICA_STICKY') else None
+    }
+    # Раз в сколько секунд сверять агрегаты /stats с полным пересчетом по users, 0 - не сверять
+    stats_reconcile_interval = float(config.get('STATS_RECONCILE_INTERVAL', 3600)) or None
+    # GROUP_COMMIT = 1 - одновременные add_user и edit_user_info коммитятся одной транзакцией:
+    # не больше GROUP_COMMIT_MAX_BATCH записей, первая ждет остальных не дольше GROUP_COMMIT_MAX_DELAY_MS
+    group_commit = {
+        'max_batch': int(config.get('GROUP_COMMIT_MAX_BATCH', 100)),
+        'max_delay_ms': float(config.get('GROUP_COMMIT_MAX_DELAY_MS', 2))
+    } if config.get('GROUP_COMMIT', '0') == '1' else None
+    db_pool = {
+        'pool_size': int(config.get('DB_POOL_SIZE', 5)),
+        'max_overflow': int(config.get('DB_MAX_OVERFLOW', 10)),
+        'pool_recycle': int(config.get('DB_POOL_RECYCLE', 3600)),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', '1') == '1'
+    }
 
     server = Server(
         host=server_host,
@@ -327,6 +599,41 @@ if __name__ == '__main__':
         db_host=db_host,
         user=db_user,
         password=db_password,
-        db_name=db_name
+        db_name=db_name,
+        optimistic_insert=optimistic_insert,
+        bulk_batch_size=bulk_batch_size,
+        max_page_size=max_page_size,
+        non_negative_balance=non_negative_balance,
+        read_path=read_path,
+        db_url=db_url,
+        slow_request_ms=slow_request_ms,
+        db_pool=db_pool,
+        user_cache=user_cache,
+        api_users=allow_api_users,
+        credential_cache=credential_cache,
+        rebuild_db=rebuild_db,
+        migrate_schema=migrate_schema,
+        compress_min_size=compress_min_size,
+        compress_level=compress_level,
+        max_multi_get=max_multi_get,
+        admission=admission,
+        retry_after=retry_after,
+        db_replicas=db_replicas,
+        replica_options=replica_options,
+        stats_reconcile_interval=stats_reconcile_interval,
+        group_commit=group_commit
+    )
+    server.startup_timings = {
+        'imports': imports_done - started_at,
+        'config': config_done - imports_done,
+        'schema': server.startup_timings['schema'],
+        'total': time.perf_counter() - started_at
+    }
+    startup_phases = ', '.join(f'{phase} {seconds * 1000:.0f}ms' for phase, seconds in server.startup_timings.items())
+    logger.info(f'startup in {server.startup_timings["total"] * 1000:.0f}ms: {startup_phases}')
+    server_workers = int(config['SERVER_WORKERS']) if config.get('SERVER_WORKERS') else None  # По умолчанию по числу ядер
+    server.runserver(
+        mode=config.get('SERVER_MODE', 'development'),
+        workers=server_workers,
+        graceful_timeout=float(config.get('SERVER_GRACEFUL_TIMEOUT', 30))
     )
-    server.runserver()
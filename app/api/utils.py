@@ -1,3 +1,7 @@
+import codecs
+import datetime
+import json
+import uuid
 
 
 def config_parser(config_path):
@@ -8,3 +12,136 @@ def config_parser(config_path):
             k, v = line.split(' = ')
             config[k] = v.split('\n')[0]
         return config
+
+
+def is_valid_uuid(value):
+    # Та же проверка, что делает UUIDType при биндинге параметра, только без похода в БД
+    try:
+        uuid.UUID(str(value))
+    except ValueError:
+        return False
+    return True
+
+
+def parse_date(value):
+    # 'YYYY-MM-DD' -> date, пустое значение -> None. Кривая дата - ValueError
+    if not value:
+        return None
+    return datetime.date.fromisoformat(value)
+
+
+# Сколько символов в хвосте буфера может занимать недочитанное значение (обрезанный литерал или число)
+INCOMPLETE_TAIL = 16
+
+
+def incomplete_json(error, buffer):
+    # Ошибка разбора из-за того, что значение дочитано не до конца, а не из-за кривого JSON.
+    # Недочитанная строка сообщает позицию своего начала, обрезанный литерал (tru, nul, -) - позицию в хвосте буфера
+    return error.msg.startswith('Unterminated string') or error.pos >= len(buffer) - INCOMPLETE_TAIL
+
+
+def iter_json_records(stream, chunk_size=64 * 1024, max_record_size=1024 * 1024):
+    # Разбираем тело по кускам, не загружая его в память целиком.
+    # Понимает NDJSON (объект на строку) и JSON-массив объектов. Отдает пары (запись, текст ошибки).
+    # Запись длиннее max_record_size - ошибка, буфер не растет дальше одной записи
+    try:
+        yield from read_json_records(stream, chunk_size, max_record_size)
+    except UnicodeDecodeError:
+        yield None, 'invalid UTF-8, the rest of the body is skipped'
+
+
+def read_json_records(stream, chunk_size, max_record_size):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(lambda: stream.read(chunk_size), b'')
+    buffer = ''
+    eof = False
+    decode_error = None
+
+    def read_more():
+        # Битый UTF-8: отдаем в буфер то, что было до него, а ошибку поднимаем, когда понадобятся данные дальше
+        nonlocal buffer, eof, decode_error
+        if decode_error is not None:
+            raise decode_error
+        chunk = next(chunks, None)
+        try:
+            if chunk is None:
+                buffer += text_decoder.decode(b'', final=True)
+                eof = True
+            else:
+                buffer += text_decoder.decode(chunk)
+        except UnicodeDecodeError as e:
+            buffer += e.object[:e.start].decode('utf-8')
+            decode_error = e
+
+    # По первому значащему символу понимаем формат
+    while not eof and not buffer.lstrip():
+        read_more()
+    buffer = buffer.lstrip()
+    if not buffer:
+        return
+
+    if not buffer.startswith('['):
+        skipping = False  # Пропускаем хвост слишком длинной строки до ближайшего перевода строки
+        while True:
+            *lines, buffer = buffer.split('\n')
+            for line in lines:
+                if skipping:
+                    skipping = False
+                elif line.strip():
+                    yield parse_json_line(line)
+            if eof:
+                break
+            if len(buffer) > max_record_size:
+                if not skipping:
+                    yield None, f'record is more than {max_record_size} characters'
+                skipping = True
+                buffer = ''
+            read_more()
+        if buffer.strip() and not skipping:
+            yield parse_json_line(buffer)
+        return
+
+    # JSON-массив: после '[' ждем значение, затем ',' или ']'
+    buffer = buffer[1:]
+    while True:
+        buffer = buffer.lstrip()
+        while not buffer and not eof:
+            read_more()
+            buffer = buffer.lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError as e:
+            # В массиве после кривого значения границу следующей записи не найти: дальше не разбираем
+            if eof or not incomplete_json(e, buffer):
+                yield None, 'invalid JSON, the rest of the body is skipped'
+                return
+            record, end = None, None
+        # Число на краю буфера может быть недочитанным: обрезанное после '.' или 'e' (-2. или 1e) разбирается
+        # как -2 или 1 с концом чуть раньше края. Ждем, пока за ним не окажется запас символов
+        number = isinstance(record, (int, float)) and not isinstance(record, bool)
+        if end is None or (number and end >= len(buffer) - INCOMPLETE_TAIL and not eof):
+            if len(buffer) > max_record_size:
+                yield None, f'record is more than {max_record_size} characters, the rest of the body is skipped'
+                return
+            read_more()
+            continue
+        yield record, None
+        buffer = buffer[end:].lstrip()
+        while not buffer and not eof:
+            read_more()
+            buffer = buffer.lstrip()
+        if buffer.startswith(','):
+            buffer = buffer[1:]
+        elif not buffer.startswith(']'):
+            yield None, 'invalid JSON'
+            return
+
+
+def parse_json_line(line):
+    try:
+        return json.loads(line), None
+    except ValueError:
+        return None, 'invalid JSON'
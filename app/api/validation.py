@@ -0,0 +1,146 @@
+from app.api.utils import is_valid_uuid, parse_date
+
+# Диапазон INT колонок users.balance и balance_adjustments.delta
+INT_MIN = -2 ** 31
+INT_MAX = 2 ** 31 - 1
+
+
+def validate_new_user(request_body):
+    # Правила валидации для add_user и add_users. Возвращает (поля пользователя, None) или (None, текст ошибки)
+    if not isinstance(request_body, dict):
+        return None, 'request body must be an object'
+
+    # get вместо try/except KeyError: необязательные параметры могли не передать
+    if 'uuid' not in request_body:
+        return None, 'UUID id can be null'
+    uuid = request_body['uuid']
+    if uuid == '' or uuid is None:
+        return None, 'UUID can not be null'
+    if not is_valid_uuid(uuid):
+        return None, 'UUID Type error'
+
+    username = request_body.get('username') or None
+    email = request_body.get('email') or None
+    phone = request_body.get('phone') or None
+    for field, value in (('username', username), ('email', email), ('phone', phone)):
+        if value is not None and type(value) is not str:
+            return None, f'type parameter {field} must be a string'
+
+    gender = request_body.get('gender')
+    if gender == '' or gender is None:
+        return None, 'gender can not be null'
+    if type(gender) is not str:
+        return None, 'type parameter gender must be a string'
+
+    gender_search = request_body.get('gender_search')
+    if gender_search == '' or gender_search is None:
+        return None, 'gender_search can not be null'
+    if type(gender_search) is not str:
+        return None, 'type parameter gender_search must be a string'
+
+    balance = request_body.get('balance')
+    if balance == '' or balance is None:
+        balance = 0
+    # Строку с целым числом раньше молча приводил MySQL, оставляем ее рабочей
+    if type(balance) is str and balance.lstrip('-').isdigit():
+        balance = int(balance)
+    if type(balance) is not int:
+        return None, 'balance must be an integer'
+    if not INT_MIN <= balance <= INT_MAX:
+        return None, f'balance must be between {INT_MIN} and {INT_MAX}'
+
+    birthday = request_body.get('birthday')
+    if birthday == '' or birthday is None:
+        return None, 'birthday can not be null'
+    # Дату разбираем сами: MySQL молча превращает мусор в 0000-00-00, а SQLite принимает только date
+    try:
+        birthday = parse_date(birthday)
+    except (TypeError, ValueError):
+        return None, 'birthday must be a date in YYYY-MM-DD format'
+
+    # Валидируем параметры на соответствие требованиям sql
+    # Необязательные параметры
+    if username is not None and len(username) > 50:
+        return None, 'username is more than 50 characters '
+    if email is not None and len(email) > 40:
+        return None, 'email is more 40 characters'
+    if phone is not None and len(phone) > 20:
+        return None, 'phone is more 20 characters'
+
+    user = {
+        'uuid': uuid,
+        'username': username,
+        'email': email,
+        'phone': phone,
+        'gender': gender,
+        'gender_search': gender_search,
+        'balance': balance,
+        'birthday': birthday
+    }
+    return user, None
+
+
+def validate_balance_adjustment(request_body, uuid=None):
+    # Одно изменение баланса. uuid передается из url для /adjust_balance/<uuid>, иначе берется из тела
+    if not isinstance(request_body, dict):
+        return None, 'adjustment must be an object'
+    if uuid is None:
+        uuid = request_body.get('uuid')
+    if uuid is None or not is_valid_uuid(uuid):
+        return None, 'UUID Type error'
+
+    delta = request_body.get('delta')
+    # bool - тоже int, но баланс на True никто менять не собирался
+    if type(delta) is not int:
+        return None, 'delta must be an integer'
+    if not INT_MIN <= delta <= INT_MAX:
+        return None, f'delta must be between {INT_MIN} and {INT_MAX}'
+
+    idempotency_key = request_body.get('idempotency_key')
+    if idempotency_key is not None:
+        if type(idempotency_key) is not str or idempotency_key == '':
+            return None, 'idempotency_key must be a non-empty string'
+        elif len(idempotency_key) > 64:
+            return None, 'idempotency_key cannot be more than 64 characters'
+
+    return {'uuid': uuid, 'delta': delta, 'idempotency_key': idempotency_key}, None
+
+
+def validate_user_changes(request_body):
+    # Правила для edit_user_info. Возвращает ({колонка: новое значение}, None) или (None, текст ошибки).
+    # Проверяются все переданные поля, а не только первое
+    if not isinstance(request_body, dict):
+        return None, 'Bad request body'
+    changes = dict()
+
+    # (поле запроса, колонка, максимальная длина)
+    for field, column, max_length in (('new_username', 'username', 50), ('new_email', 'email', 40),
+                                      ('new_phone', 'phone', 20), ('new_gender', 'gender', 10),
+                                      ('new_gender_search', 'gender_search', 10)):
+        value = request_body.get(field)
+        if value is None or (column == 'username' and value == ''):
+            continue
+        if type(value) is not str:
+            return None, f'type parameter {field} must be a string'
+        elif len(value) > max_length:
+            return None, f'{field} cannot be more than {max_length} characters'
+        changes[column] = value
+
+    new_balance = request_body.get('new_balance')
+    if new_balance is not None:
+        if type(new_balance) is not int:
+            return None, 'new_balance must be a integer'
+        if not INT_MIN <= new_balance <= INT_MAX:
+            return None, f'new_balance must be between {INT_MIN} and {INT_MAX}'
+        changes['balance'] = new_balance
+
+    new_birthday = request_body.get('new_birthday')
+    if new_birthday is not None and new_birthday != '':
+        try:
+            changes['birthday'] = parse_date(new_birthday)
+        except (TypeError, ValueError):
+            return None, 'new_birthday must be a date in YYYY-MM-DD format'
+
+    if not changes:
+        return None, 'Nothing to change'
+    return changes, None
@@ -0,0 +1,110 @@
+import argparse
+import random
+import statistics
+import time
+import uuid as uuid_lib
+import datetime
+
+from sqlalchemy import Column, MetaData, Table, VARCHAR, INT, DATE, select, text
+from sqlalchemy_utils import UUIDType
+
+from app.api.utils import config_parser
+from app.db.client.client import MySQLConnection
+
+# Сравнение хранения uuid в CHAR(32) и BINARY(16): размер данных и индексов, задержка поиска по ключу как в check_uuid.
+#   python -m app.db.bench_uuid --config=./app/api/config.txt --rows=200000 --lookups=20000
+# Создает и в конце удаляет таблицы bench_users_char и bench_users_binary
+
+
+def make_table(metadata, name, binary):
+    return Table(
+        name, metadata,
+        Column('uuid', UUIDType(binary=binary), primary_key=True),
+        Column('username', VARCHAR(50), unique=True),
+        Column('email', VARCHAR(40), unique=True),
+        Column('phone', VARCHAR(20), unique=True),
+        Column('gender', VARCHAR(10), nullable=False),
+        Column('gender_search', VARCHAR(10), nullable=False),
+        Column('balance', INT, nullable=False, default=0),
+        Column('birthday', DATE, nullable=False),
+    )
+
+
+def fill(engine, table, uuids, batch_size=5000):
+    for start in range(0, len(uuids), batch_size):
+        rows = [{
+            'uuid': value,
+            'username': f'user{start + i}',
+            'email': f'user{start + i}@example.com',
+            'phone': f'+7{start + i:010d}',
+            'gender': 'm',
+            'gender_search': 'f',
+            'balance': 0,
+            'birthday': datetime.date(1990, 1, 1)
+        } for i, value in enumerate(uuids[start:start + batch_size])]
+        with engine.begin() as connection:
+            connection.execute(table.insert(), rows)
+
+
+def table_size(engine, db_name, table):
+    with engine.begin() as connection:
+        connection.execute(text(f'ANALYZE TABLE {table.name}'))
+        row = connection.execute(text(
+            'SELECT DATA_LENGTH, INDEX_LENGTH FROM information_schema.TABLES '
+            'WHERE TABLE_SCHEMA = :db AND TABLE_NAME = :table'
+        ), {'db': db_name, 'table': table.name}).first()
+    return {'data_bytes': row[0], 'index_bytes': row[1]}
+
+
+def lookup_latency(engine, table, uuids, lookups):
+    timings = []
+    with engine.connect() as connection:
+        for value in random.choices(uuids, k=lookups):
+            started = time.perf_counter()
+            connection.execute(select(text('1')).select_from(table).where(table.c.uuid == value).limit(1)).first()
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        'p50_ms': round(statistics.median(timings), 4),
+        'p99_ms': round(timings[int(len(timings) * 0.99) - 1], 4),
+        'mean_ms': round(statistics.mean(timings), 4)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, dest='config')
+    parser.add_argument('--rows', type=int, dest='rows', default=200000)
+    parser.add_argument('--lookups', type=int, dest='lookups', default=20000)
+    args = parser.parse_args()
+    config = config_parser(args.config)
+
+    mysql_connection = MySQLConnection(
+        host=config['DB_HOST'],
+        port=config['DB_PORT'],
+        user=config['DB_USER'],
+        password=config['DB_PASSWORD'],
+        db_name=config['DB_NAME']
+    )
+    engine = mysql_connection.engine
+    metadata = MetaData()
+    tables = {
+        'CHAR(32)': make_table(metadata, 'bench_users_char', binary=False),
+        'BINARY(16)': make_table(metadata, 'bench_users_binary', binary=True)
+    }
+    uuids = [uuid_lib.uuid4() for _ in range(args.rows)]
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    try:
+        for storage, table in tables.items():
+            fill(engine, table, uuids)
+            size = table_size(engine, mysql_connection.db_name, table)
+            latency = lookup_latency(engine, table, uuids, args.lookups)
+            print(f'{storage}: {size}, lookup {latency}')
+    finally:
+        metadata.drop_all(engine)
+        mysql_connection.dispose()
+
+
+if __name__ == '__main__':
+    main()
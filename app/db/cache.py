@@ -0,0 +1,258 @@
+import pickle
+import threading
+import time
+import uuid as uuid_lib
+from collections import OrderedDict
+
+from app.db.exceptions import UserNotFoundException
+
+
+# Заполнение кэша после чтения из БД не должно перетирать invalidate, случившийся во время чтения:
+# иначе старая версия строки вернется в кэш на весь ttl. Перед чтением из БД читатель получает токен
+# заполнения (begin_fill), delete токен сбрасывает, а set с токеном пишет, только если токен еще действует
+
+
+class LocalCacheBackend:
+    # LRU в памяти процесса. Значения протухают по ttl, при переполнении вытесняется самое старое
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (value, время протухания)
+        self._fills = OrderedDict()  # key -> токен незавершенного заполнения
+        self._written = OrderedDict()  # key -> до какого времени считается недавно записанным
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, entry[0]
+
+    def begin_fill(self, key):
+        token = object()
+        with self._lock:
+            self._fills[key] = token
+            self._fills.move_to_end(key)
+            # Токены упавших чтений никто не заберет, держим их не больше, чем записей
+            while len(self._fills) > self.max_size:
+                self._fills.popitem(last=False)
+        return token
+
+    def begin_fill_many(self, keys):
+        return {key: self.begin_fill(key) for key in keys}
+
+    def set(self, key, value, ttl, token=None):
+        with self._lock:
+            if token is not None:
+                if self._fills.get(key) is not token:
+                    return  # Ключ инвалидировали (или заполняет более поздний читатель)
+                del self._fills[key]
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_many(self, keys):
+        return {key: self.get(key) for key in keys}
+
+    def set_many(self, values, ttls, tokens=None):
+        for key, value in values.items():
+            self.set(key, value, ttls[key], token=tokens[key] if tokens is not None else None)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._fills.pop(key, None)
+
+    def mark_written(self, key, ttl):
+        with self._lock:
+            self._written[key] = time.monotonic() + ttl
+            self._written.move_to_end(key)
+            while len(self._written) > self.max_size:
+                self._written.popitem(last=False)
+
+    def written_recently(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            return any(self._written.get(key, 0) > now for key in keys)
+
+    def size(self):
+        return len(self._entries)
+
+
+class RedisCacheBackend:
+    # Общий кэш для нескольких процессов/машин. Нужен пакет redis, в requirements его нет
+    # Проверка токена и запись одним скриптом: между ними не вклинится delete из другого процесса
+    FILL_SCRIPT = '''
+        if redis.call('GET', KEYS[2]) == ARGV[1] then
+            redis.call('DEL', KEYS[2])
+            return redis.call('SETEX', KEYS[1], ARGV[2], ARGV[3])
+        end
+        return 0
+    '''
+
+    def __init__(self, url, prefix='user:', fill_ttl=30):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError('USER_CACHE_BACKEND = redis requires the redis package')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.fill_prefix = prefix + 'fill:'
+        self.written_prefix = prefix + 'written:'
+        self.fill_ttl = fill_ttl  # Сколько живет токен заполнения, если читатель так и не записал значение
+        self.evictions = 0  # Вытеснением занимается сам redis (maxmemory-policy)
+        self._fill = self.client.register_script(self.FILL_SCRIPT)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return False, None
+        return True, pickle.loads(value)
+
+    def begin_fill(self, key):
+        token = uuid_lib.uuid4().hex
+        self.client.set(self.fill_prefix + key, token, ex=self.fill_ttl)
+        return token
+
+    def begin_fill_many(self, keys):
+        tokens = {key: uuid_lib.uuid4().hex for key in keys}
+        pipeline = self.client.pipeline(transaction=False)
+        for key, token in tokens.items():
+            pipeline.set(self.fill_prefix + key, token, ex=self.fill_ttl)
+        pipeline.execute()
+        return tokens
+
+    def set(self, key, value, ttl, token=None, client=None):
+        client = client or self.client
+        if token is None:
+            client.setex(self.prefix + key, max(1, int(ttl)), pickle.dumps(value))
+        else:
+            self._fill(keys=[self.prefix + key, self.fill_prefix + key],
+                       args=[token, max(1, int(ttl)), pickle.dumps(value)], client=client)
+
+    def get_many(self, keys):
+        # Один MGET на всю пачку вместо запроса на каждый ключ
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {key: (False, None) if value is None else (True, pickle.loads(value)) for key, value in zip(keys, values)}
+
+    def set_many(self, values, ttls, tokens=None):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            self.set(key, value, ttls[key], token=tokens[key] if tokens is not None else None, client=pipeline)
+        pipeline.execute()
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key, self.fill_prefix + key)
+
+    def mark_written(self, key, ttl):
+        self.client.set(self.written_prefix + key, 1, px=max(1, int(ttl * 1000)))
+
+    def written_recently(self, keys):
+        return any(value is not None for value in self.client.mget([self.written_prefix + key for key in keys]))
+
+    def size(self):
+        return None
+
+
+class UserCache:
+    # Read-through кэш профилей для DBInteraction.get_user_info.
+    # Отсутствующие uuid тоже кэшируются (значение None), но на меньший срок
+    def __init__(self, backend=None, ttl=60, negative_ttl=5, written_ttl=None):
+        self.backend = backend if backend is not None else LocalCacheBackend()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        # Сколько секунд после записи uuid помечен как недавно записанный (см. written_recently), None - не помечать
+        self.written_ttl = written_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(uuid):
+        # Один и тот же uuid может прийти в разном написании
+        return uuid_lib.UUID(str(uuid)).hex
+
+    def get_or_load(self, uuid, loader):
+        key = self.key(uuid)
+        found, user = self.backend.get(key)
+        with self._lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not found:
+            token = self.backend.begin_fill(key)
+            try:
+                user = loader(uuid)
+            except UserNotFoundException:
+                user = None
+            # Если за время чтения пользователя изменили, значение не запишется: следующий запрос прочитает свежее
+            self.backend.set(key, user, self.ttl if user is not None else self.negative_ttl, token=token)
+        if user is None:
+            raise UserNotFoundException('User not found')
+        return dict(user)
+
+    def get_or_load_many(self, uuids, loader):
+        # То же для пачки: loader получает список промахов и возвращает {uuid: профиль} только для найденных.
+        # Результат - {uuid: профиль или None}
+        keys = {uuid: self.key(uuid) for uuid in uuids}
+        cached = self.backend.get_many(list(keys.values()))
+        users = dict()
+        missing = []
+        for uuid, key in keys.items():
+            found, user = cached[key]
+            if found:
+                users[uuid] = dict(user) if user is not None else None
+            else:
+                missing.append(uuid)
+        with self._lock:
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            tokens = self.backend.begin_fill_many([keys[uuid] for uuid in missing])
+            loaded = loader(missing)
+            values = dict()
+            ttls = dict()
+            for uuid in missing:
+                user = loaded.get(uuid)
+                values[keys[uuid]] = user
+                ttls[keys[uuid]] = self.ttl if user is not None else self.negative_ttl
+                users[uuid] = dict(user) if user is not None else None
+            self.backend.set_many(values, ttls, tokens=tokens)
+        return users
+
+    def invalidate(self, uuid):
+        key = self.key(uuid)
+        if self.written_ttl:
+            self.backend.mark_written(key, self.written_ttl)
+        self.backend.delete(key)
+
+    def written_recently(self, uuids):
+        # Метка в том же хранилище, что и кэш: с redis ее видят все воркеры, а не только сделавший запись.
+        # ReplicaRouter по ней читает такие uuid с мастера, и отстающая реплика не вернет в кэш старую строку
+        if not self.written_ttl:
+            return False
+        return self.backend.written_recently([self.key(uuid) for uuid in uuids])
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions,
+            'size': self.backend.size()
+        }
+
+
+def make_user_cache(backend, max_size, ttl, negative_ttl, redis_url=None):
+    if backend == 'off':
+        return None
+    if backend == 'redis':
+        return UserCache(RedisCacheBackend(redis_url), ttl=ttl, negative_ttl=negative_ttl)
+    return UserCache(LocalCacheBackend(max_size=max_size), ttl=ttl, negative_ttl=negative_ttl)
@@ -1,39 +1,115 @@
+import threading
+
 import sqlalchemy
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 
 class MySQLConnection:
-    def __init__(self, host, port, user, password, db_name, rebuild_db=False):
+    def __init__(self, host, port, user, password, db_name, rebuild_db=False,
+                 pool_size=5, max_overflow=10, pool_recycle=3600, pool_pre_ping=True, url=None):
+        # url - готовая строка подключения вместо MySQL из host/port (например sqlite:///bench.db для прогонов в CI)
+        self.url = url
         self.user = user
         self.password = password
         self.db_name = db_name
         self.host = host
         self.port = port
         self.rebuild_db = rebuild_db
-        self.connection = self.connect()
-        session = sessionmaker(
-            bind=self.connection.engine,
+        # Параметры пула соединений: постоянные соединения, сверх них на пике, время жизни и проверка перед выдачей
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+        self.pool_pre_ping = pool_pre_ping
+        # Функции, которые навешиваются на каждый новый engine (например хуки метрик), в т.ч. после reconnect
+        self.engine_hooks = []
+        # Engine создается при первом обращении к engine или session, конструктор в БД не ходит
+        self._engine = None
+        self._engine_lock = threading.Lock()
+        self.session_factory = sessionmaker(
             autocommit=True,  # не нужно будет делать коммит после каждого подключения
             autoflush=True,
             enable_baked_queries=False,
             expire_on_commit=True  # Чтоб не было конфликтов с другими сессиями работающими одновременно
         )
-        self.session = session()
+        # У каждого потока (запроса) своя сессия со своим соединением из пула.
+        # Сессия создается при первом обращении и отдается обратно в пул через remove() в конце запроса
+        self._session = scoped_session(self.session_factory)
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self.open()
+        return self._engine
+
+    @property
+    def session(self):
+        if self._engine is None:
+            self.open()
+        return self._session
+
+    def open(self):
+        with self._engine_lock:
+            if self._engine is None:
+                self.bind(self.connect())
+
+    def bind(self, engine):
+        for hook in self.engine_hooks:
+            hook(engine)
+        self.session_factory.configure(bind=engine)
+        self._engine = engine
 
-    def get_connection(self, db_created=False):
-        engine = sqlalchemy.create_engine(
+    def get_engine(self, db_created=False):
+        if self.url is not None:
+            if self.url.startswith('sqlite'):
+                # У SQLite свой пул, настройки MySQL-пула к нему не применимы
+                return sqlalchemy.create_engine(self.url, connect_args={'check_same_thread': False})
+            return sqlalchemy.create_engine(
+                self.url,
+                pool_size=self.pool_size,
+                max_overflow=self.max_overflow,
+                pool_recycle=self.pool_recycle,
+                pool_pre_ping=self.pool_pre_ping
+            )
+        return sqlalchemy.create_engine(
             f'mysql+pymysql://{self.user}:{self.password}@{self.host}:{self.port}/{self.db_name if db_created else ""}',
-            encoding='utf8'
+            encoding='utf8',
+            pool_size=self.pool_size,
+            max_overflow=self.max_overflow,
+            pool_recycle=self.pool_recycle,
+            pool_pre_ping=self.pool_pre_ping
         )
-        return engine.connect()
 
     def connect(self):
-        connection = self.get_connection()
-        if self.rebuild_db:
-            connection.execute(f'DROP DATABASE IF EXISTS {self.db_name}')
-            connection.execute(f'CREATE DATABASE {self.db_name}')
-        return self.get_connection(db_created=True)
+        # Пересоздаем базу только для MySQL из host/port, для url хватит пересоздания таблиц
+        if self.rebuild_db and self.url is None:
+            engine = self.get_engine()
+            with engine.connect() as connection:
+                connection.execute(f'DROP DATABASE IF EXISTS {self.db_name}')
+                connection.execute(f'CREATE DATABASE {self.db_name}')
+            engine.dispose()
+        return self.get_engine(db_created=True)
 
     def execute_query(self, query):
-        res = self.connection.execute(query)
+        with self.engine.begin() as connection:
+            res = connection.execute(query)
         return res
+
+    def remove_session(self):
+        self._session.remove()
+
+    def dispose(self):
+        # Закрываем все соединения пула (например перед fork)
+        self._session.remove()
+        if self._engine is not None:
+            self._engine.dispose()
+
+    def add_engine_hook(self, hook):
+        self.engine_hooks.append(hook)
+        if self._engine is not None:
+            hook(self._engine)
+
+    def reconnect(self):
+        # Новый engine со своим пулом, например в процессе-воркере после fork. База уже создана, не пересоздаем
+        with self._engine_lock:
+            self.bind(self.get_engine(db_created=True))
+        self._session.remove()
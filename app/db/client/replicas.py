@@ -0,0 +1,145 @@
+import itertools
+import threading
+import time
+import uuid as uuid_lib
+from collections import Counter
+
+from loguru import logger
+from sqlalchemy import text
+
+# Распределение чтений по репликам для DBInteraction.
+# Чтения идут по кругу на здоровые реплики с отставанием не больше max_lag секунд, если таких нет - на мастер.
+# На мастер же идут чтения в запросе, который уже что-то записал, и чтения uuid, записанного меньше
+# sticky_seconds назад (иначе кэш мог бы набраться старой версии с отстающей реплики). Свои записи процесс
+# помнит сам, записи других воркеров и машин видны через shared_written_recently (метки в общем кэше).
+# Здоровье и отставание проверяет фоновый поток раз в check_interval секунд
+
+
+class ReplicaState:
+    def __init__(self, name, connection):
+        self.name = name
+        self.connection = connection  # MySQLConnection реплики
+        self.healthy = True  # До первой проверки считаем живой
+        self.lag = None  # Секунды отставания, None - неизвестно (не MySQL или не реплика)
+        self.error = None
+
+
+def replication_lag(connection):
+    # Seconds_Behind_Source (8.0.22+) или Seconds_Behind_Master. Не реплика или не MySQL - None
+    if connection.dialect.name != 'mysql':
+        connection.execute(text('SELECT 1'))
+        return None
+    try:
+        row = connection.execute(text('SHOW REPLICA STATUS')).mappings().first()
+    except Exception:
+        row = connection.execute(text('SHOW SLAVE STATUS')).mappings().first()
+    if row is None:
+        return None
+    lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+    if lag is None:
+        # Поток репликации остановлен: данные могут быть сколько угодно старыми
+        raise RuntimeError('replication is not running')
+    return int(lag)
+
+
+class ReplicaRouter:
+    def __init__(self, primary, replicas, max_lag=5, check_interval=5, sticky_seconds=None):
+        # primary - MySQLConnection мастера, replicas - {имя: MySQLConnection}
+        self.primary = primary
+        self.replicas = [ReplicaState(name, connection) for name, connection in replicas.items()]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.sticky_seconds = max_lag if sticky_seconds is None else sticky_seconds
+        self.routes = Counter()  # (куда, почему) -> число чтений
+        self._recent_writes = dict()  # uuid.hex -> до какого времени читать его с мастера
+        self.shared_written_recently = None  # Функция от списка uuid, например UserCache.written_recently
+        self._request = threading.local()
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def pin_request(self):
+        # Текущий запрос записал данные: дальше в нем читаем только с мастера
+        self._request.pinned = True
+
+    def unpin_request(self):
+        self._request.pinned = False
+
+    def note_write(self, uuid):
+        self.pin_request()
+        with self._lock:
+            self._recent_writes[uuid_lib.UUID(str(uuid)).hex] = time.monotonic() + self.sticky_seconds
+
+    def written_recently(self, uuids):
+        now = time.monotonic()
+        with self._lock:
+            for uuid in uuids:
+                deadline = self._recent_writes.get(uuid_lib.UUID(str(uuid)).hex)
+                if deadline is not None and deadline > now:
+                    return True
+        if self.shared_written_recently is not None:
+            return self.shared_written_recently(uuids)
+        return False
+
+    def choose(self, uuids=()):
+        # MySQLConnection для чтения. uuids - пользователи, которых читаем, если известны
+        if getattr(self._request, 'pinned', False):
+            return self.route(self.primary, 'primary', 'request_wrote')
+        if uuids and self.written_recently(uuids):
+            return self.route(self.primary, 'primary', 'recent_write')
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return self.route(self.primary, 'primary', 'no_healthy_replica')
+        replica = healthy[next(self._next) % len(healthy)]
+        return self.route(replica.connection, replica.name, 'replica')
+
+    def route(self, connection, target, reason):
+        with self._lock:
+            self.routes[(target, reason)] += 1
+        return connection
+
+    def check(self):
+        for replica in self.replicas:
+            try:
+                with replica.connection.engine.connect() as connection:
+                    lag = replication_lag(connection)
+                healthy = lag is None or lag <= self.max_lag
+                error = None if healthy else f'lag {lag}s is over {self.max_lag}s'
+            except Exception as e:
+                lag, healthy, error = None, False, str(e)
+            if healthy != replica.healthy:
+                if healthy:
+                    logger.info(f'replica {replica.name} is back, lag {lag}')
+                else:
+                    logger.warning(f'replica {replica.name} taken out of rotation: {error}')
+            replica.lag, replica.healthy, replica.error = lag, healthy, error
+        # Протухшие отметки о записях больше не нужны
+        now = time.monotonic()
+        with self._lock:
+            self._recent_writes = {key: deadline for key, deadline in self._recent_writes.items() if deadline > now}
+
+    def run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.check_interval)
+
+    def start(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='replica-health', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.check_interval + 1)
+            self._thread = None
+
+    def stats(self):
+        with self._lock:
+            routes = dict(self.routes)
+        return {
+            'replicas': [{'name': replica.name, 'healthy': replica.healthy, 'lag': replica.lag, 'error': replica.error}
+                         for replica in self.replicas],
+            'routes': routes
+        }
@@ -3,4 +3,36 @@ class UserNotFoundException(Exception):
 
 
 class OperationalErrorException(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class UserAlreadyExistsException(Exception):
+    # field - имя колонки, на уникальном ключе которой упала вставка
+    def __init__(self, field):
+        self.field = field
+        super().__init__(f'{field} already used')
+
+
+class InsufficientBalanceException(Exception):
+    # uuids - пользователи, у которых баланс ушел бы в минус
+    def __init__(self, uuids):
+        self.uuids = uuids
+        super().__init__(f'Insufficient balance: {", ".join(str(uuid) for uuid in uuids)}')
+
+
+class BalanceOutOfRangeException(Exception):
+    # uuids - пользователи, баланс которых после изменения не влезает в колонку
+    def __init__(self, uuids):
+        self.uuids = uuids
+        super().__init__(f'Balance out of range: {", ".join(str(uuid) for uuid in uuids)}')
+
+
+class IdempotencyKeyConflictException(Exception):
+    # keys - idempotency_key, уже записанные в журнал с другим uuid или delta
+    def __init__(self, keys):
+        self.keys = keys
+        super().__init__(f'idempotency_key reused with different parameters: {", ".join(keys)}')
+
+
+class SchemaMigrationException(Exception):
+    pass
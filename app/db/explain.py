@@ -0,0 +1,99 @@
+import argparse
+import sys
+import uuid as uuid_lib
+import datetime
+
+from sqlalchemy import select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from app.api.utils import config_parser
+from app.db.client.client import MySQLConnection
+from app.db.interaction.readers import SELECT_USER_BY_UUID, SELECT_USERS_BY_UUIDS, EXISTS_BY
+from app.db.models.models import User
+
+# Отчет EXPLAIN по горячим запросам DBInteraction: какой индекс использует каждый запрос.
+# Если запрос перестал попадать в ожидаемый индекс, скрипт завершается с кодом 1
+#   python -m app.db.explain --config=./app/api/config.txt
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def visit_explain(element, compiler, **kw):
+    return 'EXPLAIN ' + compiler.process(element.statement, **kw)
+
+
+@compiles(Explain, 'sqlite')
+def visit_explain_sqlite(element, compiler, **kw):
+    return 'EXPLAIN QUERY PLAN ' + compiler.process(element.statement, **kw)
+
+
+def hot_queries():
+    # (имя метода DBInteraction, запрос, ожидаемый индекс)
+    users = User.__table__
+    some_uuid = uuid_lib.uuid4()
+    return [
+        ('get_user_info', SELECT_USER_BY_UUID.params(uuid=some_uuid), 'PRIMARY'),
+        ('get_users_info', SELECT_USERS_BY_UUIDS.params(uuids=[some_uuid, uuid_lib.uuid4()]), 'PRIMARY'),
+        ('check_uuid', EXISTS_BY['uuid'].params(value=some_uuid), 'PRIMARY'),
+        ('check_username', EXISTS_BY['username'].params(value='username'), 'username'),
+        ('check_email', EXISTS_BY['email'].params(value='email'), 'email'),
+        ('check_phone', EXISTS_BY['phone'].params(value='phone'), 'phone'),
+        ('iter_users', select(users).where(users.c.uuid > some_uuid).order_by(users.c.uuid).limit(100), 'PRIMARY'),
+        ('iter_users (filters)', select(users).where(
+            users.c.gender == 'm',
+            users.c.gender_search == 'f',
+            users.c.birthday >= datetime.date(1990, 1, 1),
+            users.c.birthday <= datetime.date(2000, 1, 1)
+        ).order_by(users.c.uuid).limit(100), 'ix_users_gender_gender_search_birthday'),
+    ]
+
+
+def explain(engine):
+    # Возвращает список (имя, ожидаемый индекс, использованный индекс, в порядке ли план, строки EXPLAIN)
+    report = []
+    with engine.connect() as connection:
+        for name, query, expected in hot_queries():
+            rows = [dict(row._mapping) for row in connection.execute(Explain(query))]
+            if engine.dialect.name == 'mysql':
+                used = rows[0].get('key') if rows else None
+                ok = used == expected
+            else:
+                # У SQLite уникальные ключи называются sqlite_autoindex_*, поэтому проверяем только отсутствие SCAN
+                used = ' '.join(str(row.get('detail')) for row in rows)
+                ok = 'USING' in used and 'SCAN' not in used
+            report.append((name, expected, used, ok, rows))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, dest='config')
+    args = parser.parse_args()
+    config = config_parser(args.config)
+
+    mysql_connection = MySQLConnection(
+        host=config['DB_HOST'],
+        port=config['DB_PORT'],
+        user=config['DB_USER'],
+        password=config['DB_PASSWORD'],
+        db_name=config['DB_NAME']
+    )
+    regressions = 0
+    for name, expected, used, ok, rows in explain(mysql_connection.engine):
+        regressions += not ok
+        print(f'{"OK " if ok else "BAD"} {name}: expected {expected}, used {used}')
+        for row in rows:
+            print(f'    {row}')
+    mysql_connection.dispose()
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
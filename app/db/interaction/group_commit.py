@@ -0,0 +1,140 @@
+import queue
+import threading
+import time
+
+from loguru import logger
+from sqlalchemy import exc
+
+# Групповой коммит для одиночных записей (add_user, edit_user_info). Без него каждый запрос - своя транзакция
+# и свой COMMIT с fsync на стороне MySQL. Здесь запросы встают в очередь, фоновый поток забирает накопившиеся
+# (не больше max_batch и не дольше max_delay_ms с первой) и выполняет их одной транзакцией, каждую в своем
+# SAVEPOINT: ошибка одной записи откатывает только ее, а вызывающий получает свой результат или свое исключение.
+# Так разбираются только ошибки одного оператора (нарушение уникальности, ошибки параметров). Прочие ошибки БД
+# (deadlock, lock wait timeout с innodb_rollback_on_timeout, потеря соединения) или неудачный ROLLBACK TO SAVEPOINT
+# могли откатить всю транзакцию вместе с соседними записями, поэтому пачка прерывается и повторяется по одной записи.
+# Цена - до max_delay_ms лишней задержки на запись
+
+
+class PendingWrite:
+    def __init__(self, operation):
+        self.operation = operation  # Функция от connection, выполняется внутри транзакции
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitWriter:
+    def __init__(self, engine_getter, max_batch=100, max_delay_ms=2):
+        self.engine_getter = engine_getter
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000
+        self.batches = 0
+        self.writes = 0
+        self.fallbacks = 0  # Пачки, которые не закоммитились целиком и были повторены по одной записи
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # Проверка, что поток работает, и постановка в очередь атомарны: после stop() за меткой остановки
+        # в очереди ничего не окажется
+        self._state_lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, operation):
+        # Выполнить operation(connection) в ближайшей пачке и вернуть ее результат (или поднять ее исключение)
+        pending = PendingWrite(operation)
+        with self._state_lock:
+            queued = self._thread is not None
+            if queued:
+                self._queue.put(pending)
+        if not queued:
+            # Поток остановлен (например, перед fork): пишем сразу, своей транзакцией
+            return self.execute(operation)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def execute(self, operation):
+        with self.engine_getter().begin() as connection:
+            return operation(connection)
+
+    def collect(self):
+        # Первая запись ждется без ограничений, остальные - пока не наберется max_batch или не выйдет max_delay
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                pending = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if pending is None:
+                # stop(): дописываем то, что уже набрали, и выходим
+                self._queue.put(None)
+                break
+            batch.append(pending)
+        return batch
+
+    def flush(self, batch):
+        try:
+            with self.engine_getter().begin() as connection:
+                for pending in batch:
+                    try:
+                        with connection.begin_nested():
+                            pending.result = pending.operation(connection)
+                    except exc.IntegrityError as e:
+                        # Сюда попадаем, только если ROLLBACK TO SAVEPOINT прошел: иначе наружу вылетает его ошибка
+                        pending.error = e
+                    except (exc.DBAPIError, exc.InvalidRequestError):
+                        raise
+                    except Exception as e:
+                        # Ошибки до отправки в БД (StatementError от параметров) и исключения самой операции
+                        pending.error = e
+        except Exception as e:
+            # Упал сам COMMIT или транзакция целиком (потеря соединения, deadlock): ничего не записано,
+            # повторяем каждую запись отдельно, чтоб ошибка досталась только тем, у кого она воспроизводится
+            logger.warning(f'group commit of {len(batch)} writes failed, retry one by one: {e}')
+            with self._lock:
+                self.fallbacks += 1
+            for pending in batch:
+                pending.result, pending.error = None, None
+                try:
+                    pending.result = self.execute(pending.operation)
+                except Exception as error:
+                    pending.error = error
+        with self._lock:
+            self.batches += 1
+            self.writes += len(batch)
+        for pending in batch:
+            pending.done.set()
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            if batch is None:
+                return
+            self.flush(batch)
+
+    def start(self):
+        with self._state_lock:
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self.run, name='group-commit', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        # Новые записи сразу идут мимо очереди, уже поставленные дописываются
+        with self._state_lock:
+            thread, self._thread = self._thread, None
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {'batches': self.batches, 'writes': self.writes, 'fallbacks': self.fallbacks,
+                    'max_batch': self.max_batch, 'max_delay_ms': self.max_delay * 1000}
@@ -1,38 +1,157 @@
 from app.db.client.client import MySQLConnection
-from app.db.exceptions import UserNotFoundException, OperationalErrorException
-from app.db.models.models import Base, User
+from app.db.client.replicas import ReplicaRouter
+from app.db.exceptions import UserNotFoundException, OperationalErrorException, UserAlreadyExistsException, \
+    InsufficientBalanceException, IdempotencyKeyConflictException, BalanceOutOfRangeException
+from app.db.models.models import User, BalanceAdjustment
+from app.db import schema
+from app.db.interaction.readers import READERS
+from app.db.interaction import stats
+from app.db.interaction.group_commit import GroupCommitWriter
 from loguru import logger
-from sqlalchemy import exc
+from sqlalchemy import exc, select, update
+from sqlalchemy.engine.url import make_url
+import uuid as uuid_lib
+import re
 
-logger.add(f'log/{__name__}.log', format='{time} {level} {message}', level='DEBUG', rotation='10 MB', compression='zip')
+# MySQL: "Duplicate entry 'x' for key 'users.email'" (до 8.0.19 без имени таблицы), SQLite: "UNIQUE constraint failed: users.email"
+DUPLICATE_KEY_RE = re.compile(r"for key '(?:\w+\.)?(\w+)'|UNIQUE constraint failed: \w+\.(\w+)")
+
+
+def conflict_field(error):
+    # Достаем из IntegrityError имя колонки, уникальность которой нарушена
+    match = DUPLICATE_KEY_RE.search(str(error.orig))
+    if match is None:
+        return None
+    field = match.group(1) or match.group(2)
+    return 'uuid' if field == 'PRIMARY' else field
+
+
+def user_to_dict(user):
+    # Подходит и для объекта User, и для строки из select по колонкам users
+    return {'uuid': user.uuid, 'username': user.username, 'email': user.email, 'phone': user.phone,
+            'Gender': user.gender, 'gender_search': user.gender_search, 'balance': user.balance,
+            'birthday': user.birthday}
 
 
 class DBInteraction:
 
-    def __init__(self, host, port, user, password, db_name, rebuild_db=False):
+    def __init__(self, host, port, user, password, db_name, rebuild_db=False, user_cache=None, read_path='core',
+                 url=None, migrate_schema=True, replicas=None, replica_options=None, stats_reconcile_interval=None,
+                 group_commit=None, **pool_options):
+        # user_cache: UserCache перед get_user_info, None - без кэша
+        # read_path: core - select по колонкам без ORM, orm - через session.query(User)
+        # migrate_schema: применить недостающие миграции схемы, False - их накатывают отдельно (python -m app.db.schema)
+        # replicas: реплики для чтений, 'host:port' (те же пользователь, пароль и база) или строка подключения.
+        # replica_options: max_lag, check_interval, sticky_seconds для ReplicaRouter
+        # stats_reconcile_interval: раз в сколько секунд сверять user_stats с полным пересчетом, None - не сверять
+        # group_commit: {'max_batch', 'max_delay_ms'} - add_user и edit_user_info коммитятся пачками, None - каждая сама
+        # pool_options: pool_size, max_overflow, pool_recycle, pool_pre_ping
+        self.user_cache = user_cache
         self.mysql_connection = MySQLConnection(
             host=host,
             port=port,
             user=user,
             password=password,
             db_name=db_name,
-            rebuild_db=rebuild_db
+            rebuild_db=rebuild_db,
+            url=url,
+            **pool_options
         )
 
-        self.engine = self.mysql_connection.connection.engine
+        self.reader = READERS[read_path](self.mysql_connection)
+        # Читатель на каждое соединение: мастер и реплики
+        self.readers = {self.mysql_connection: self.reader}
+        self.router = None
+        if replicas:
+            replica_connections = dict()
+            for replica in replicas:
+                if '://' in replica:
+                    connection = MySQLConnection(host=None, port=None, user=user, password=password, db_name=db_name,
+                                                 url=replica, **pool_options)
+                    name = repr(make_url(replica))  # Без пароля
+                else:
+                    replica_host, replica_port = replica.rsplit(':', 1)
+                    connection = MySQLConnection(host=replica_host, port=replica_port, user=user, password=password,
+                                                 db_name=db_name, **pool_options)
+                    name = replica
+                replica_connections[name] = connection
+                self.readers[connection] = READERS[read_path](connection)
+            self.router = ReplicaRouter(self.mysql_connection, replica_connections, **(replica_options or {}))
+            if user_cache is not None:
+                # Записи других процессов видны роутеру через метки в кэше (с redis - общие для всех воркеров)
+                user_cache.written_ttl = self.router.sticky_seconds
+                self.router.shared_written_recently = user_cache.written_recently
+            self.router.start()
+
+        self.stats_reconciler = None
+        if stats_reconcile_interval:
+            self.stats_reconciler = stats.StatsReconciler(lambda: self.engine, stats_reconcile_interval)
+            self.stats_reconciler.start()
+
+        self.group_commit = None
+        if group_commit is not None:
+            self.group_commit = GroupCommitWriter(lambda: self.engine, **group_commit)
+            self.group_commit.start()
 
         if rebuild_db:
-            self.create_tables()
-            # self.create_table_musical_compositions()
+            schema.reset(self.engine)  # Чистая база: все таблицы сносим, миграции накатятся с нуля
+        if migrate_schema or rebuild_db:
+            self.migrate_schema()
 
-    def create_tables(self):
-        if not self.engine.dialect.has_table(self.engine, 'users'):
-            Base.metadata.tables['users'].create(self.engine)  # Создание таблицы из моделей если нет такой
-        else:
-            # pass
-            self.mysql_connection.execute_query('DROP TABLE IF EXISTS users')  # Грохаем таблицу если такая есть
-            Base.metadata.tables['users'].create(self.engine)
-            logger.info('Table users deleted')
+    @property
+    def engine(self):
+        return self.mysql_connection.engine
+
+    def migrate_schema(self):
+        return schema.migrate(self.engine)
+
+    def connections(self):
+        # Мастер первым, за ним реплики
+        return list(self.readers)
+
+    def read_connection(self, uuids=()):
+        # Куда идти за чтением: без реплик всегда мастер
+        if self.router is None:
+            return self.mysql_connection
+        return self.router.choose(uuids)
+
+    def read_reader(self, uuids=()):
+        return self.readers[self.read_connection(uuids)]
+
+    def close_session(self, exception=None):
+        # Вызывается в конце каждого запроса: соединение сессии возвращается в пул
+        for connection in self.readers:
+            connection.remove_session()
+        if self.router is not None:
+            self.router.unpin_request()
+
+    def dispose(self):
+        # Фоновые проверки реплик тоже останавливаем: перед fork у мастера не должно остаться соединений
+        if self.router is not None:
+            self.router.stop()
+        if self.stats_reconciler is not None:
+            self.stats_reconciler.stop()
+        if self.group_commit is not None:
+            self.group_commit.stop()
+        for connection in self.readers:
+            connection.dispose()
+
+    def reconnect(self):
+        for connection in self.readers:
+            connection.reconnect()
+        if self.router is not None:
+            self.router.start()
+        if self.stats_reconciler is not None:
+            self.stats_reconciler.start()
+        if self.group_commit is not None:
+            self.group_commit.start()
+
+    def write(self, operation):
+        # operation(connection) одной транзакцией: своей или общей с соседними записями при group_commit
+        if self.group_commit is not None:
+            return self.group_commit.submit(operation)
+        with self.engine.begin() as connection:
+            return operation(connection)
 
     # def create_table_musical_compositions(self):
     #    if not self.engine.dialect.has_table(self.engine, 'musical_compositions'):
@@ -42,89 +161,344 @@ class DBInteraction:
     #        Base.metadata.tables['musical_compositions'].create(self.engine)
 
     def add_user(self, uuid, username, email, phone, gender, gender_search, balance, birthday):
+        # Один INSERT без предварительных проверок: дубли отсекают уникальные ключи таблицы
+        values = {
+            'uuid': uuid,
+            'username': username,
+            'email': email,
+            'phone': phone,
+            'gender': gender,
+            'gender_search': gender_search,
+            'balance': balance,
+            'birthday': birthday
+        }
+
+        def insert(connection):
+            # Пользователь и агрегаты /stats одной транзакцией
+            connection.execute(User.__table__.insert().values(**values))
+            stats.apply_deltas(connection, deltas)
+
         try:
-            user = User(
-                uuid=uuid,
-                username=username,
-                email=email,
-                phone=phone,
-                gender=gender,
-                gender_search=gender_search,
-                balance=balance,
-                birthday=birthday
-            )
-            self.mysql_connection.session.add(user)
-            return self.get_user_info(uuid)
-        except exc.OperationalError as e:
-            # Ошибки операций с БД пишем в лог и возвращаем 400 ошибку с пояснением.
+            deltas = dict()
+            stats.add_delta(deltas, stats.stats_key(gender, gender_search, birthday), 1, balance)
+            self.write(insert)
+        except exc.IntegrityError as e:
+            field = conflict_field(e)
+            if field is None:
+                logger.error(e)
+                raise OperationalErrorException('Bad request. Check types for parameters.')
+            raise UserAlreadyExistsException(field)
+        except (exc.OperationalError, exc.StatementError, TypeError, AttributeError) as e:
+            # Ошибки операций с БД и значения, из которых не собрать агрегаты /stats (balance не число,
+            # birthday не дата), пишем в лог и возвращаем 400 ошибку с пояснением.
             logger.error(e)
             raise OperationalErrorException('Bad request. Check types for parameters.')
+        self.invalidate_user(uuid)  # Мог быть закэширован как отсутствующий
+        # Ответ собираем из вставленных значений, без повторного select
+        return {'uuid': uuid_lib.UUID(str(uuid)), 'username': username, 'email': email, 'phone': phone,
+                'Gender': gender, 'gender_search': gender_search, 'balance': balance, 'birthday': birthday}
+
+    def add_users(self, users):
+        # Пачка пользователей одним multi-row INSERT (pymysql склеивает executemany в один INSERT ... VALUES).
+        # Возвращает список той же длины: None для вставленной строки или исключение с причиной отказа
+        if not users:
+            return []
+        try:
+            deltas = dict()
+            for user in users:
+                stats.add_delta(deltas, stats.stats_key(user['gender'], user['gender_search'], user['birthday']),
+                                1, user['balance'])
+            with self.engine.begin() as connection:
+                connection.execute(User.__table__.insert(), users)
+                stats.apply_deltas(connection, deltas)
+            for user in users:
+                self.invalidate_user(user['uuid'])
+            return [None] * len(users)
+        except (exc.StatementError, TypeError, AttributeError) as e:
+            # Пачка откатилась целиком, раскладываем ее построчно, чтоб понять какие строки не прошли
+            logger.bind(sample='bulk_retry').info(f'batch of {len(users)} users rejected, retry row by row: '
+                                                  f'{getattr(e, "orig", e)}')
+        results = []
+        for user in users:
+            try:
+                self.add_user(**user)
+                results.append(None)
+            except (UserAlreadyExistsException, OperationalErrorException) as e:
+                results.append(e)
+        return results
 
     def check_username(self, username):
-        user = self.mysql_connection.session.query(User).filter_by(username=username).first()
-        if user:
-            return True
-        else:
-            return False
+        return self.read_reader().exists('username', username)
 
     def check_uuid(self, uuid):
         try:
-            uuid = self.mysql_connection.session.query(User).filter_by(uuid=uuid).first()
+            return self.read_reader().exists('uuid', uuid)
         except Exception as e:
             logger.error(f'exception: {e}')
             return 'UUID bad value'
-        if uuid:
-            #logger.info(f'uuid: {uuid}')
-            return True
-        else:
-            return False
 
     def check_email(self, email):
-        email = self.mysql_connection.session.query(User).filter_by(email=email).first()
-        if email is not None:
-            logger.info(f'email: {str(email)}')
-            return True
-        else:
-            return False
+        return self.read_reader().exists('email', email)
 
     def check_phone(self, phone):
-        email = self.mysql_connection.session.query(User).filter_by(phone=phone).first()
-        if email:
-            return True
-        else:
-            return False
+        return self.read_reader().exists('phone', phone)
+
+    def invalidate_user(self, uuid):
+        # Вызывается после каждой записи пользователя: сбрасываем кэш, а чтения этого uuid какое-то время идут
+        # на мастер, пока реплики не догонят
+        if self.user_cache is not None:
+            self.user_cache.invalidate(uuid)
+        if self.router is not None:
+            self.router.note_write(uuid)
 
     def get_user_info(self, uuid):
+        if self.user_cache is None:
+            return self.select_user_info(uuid)
+        return self.user_cache.get_or_load(uuid, self.select_user_info)
+
+    def select_user_info(self, uuid):
         # Находим пользователя в базе
-        user = self.mysql_connection.session.query(User).filter_by(uuid=uuid).first()
+        user = self.read_reader((uuid,)).get_user(uuid)
         if user:
-            self.mysql_connection.session.expire_all()
-            return {'uuid': user.uuid, 'username': user.username, 'email': user.email, 'phone': user.phone,
-                    'Gender': user.gender, 'gender_search': user.gender_search, 'balance': user.balance,
-                    'birthday': user.birthday}
+            return user_to_dict(user)
         else:
             raise UserNotFoundException('User not found')
 
+    def get_users_info(self, uuids):
+        # Пачка профилей: {UUID: профиль или None, если такого нет}. Из кэша берется что есть, в БД идут только промахи
+        uuids = list(dict.fromkeys(uuid_lib.UUID(str(uuid)) for uuid in uuids))
+        if self.user_cache is None:
+            found = self.select_users_info(uuids)
+            return {uuid: found.get(uuid) for uuid in uuids}
+        return self.user_cache.get_or_load_many(uuids, self.select_users_info)
+
+    def select_users_info(self, uuids, chunk_size=500):
+        # WHERE uuid IN (...) пачками по chunk_size, чтоб не упираться в размер запроса. Возвращает только найденных
+        found = dict()
+        reader = self.read_reader(uuids)
+        for start in range(0, len(uuids), chunk_size):
+            for user in reader.get_users(uuids[start:start + chunk_size]):
+                found[user.uuid] = user_to_dict(user)
+        return found
+
+    def get_stats(self, cohort_years=10):
+        # Агрегаты из user_stats, GROUP BY по users не делается. Чтение можно отдать реплике
+        with self.read_connection().engine.connect() as connection:
+            return stats.summarize(connection, cohort_years=cohort_years)
+
+    def reconcile_stats(self):
+        return stats.reconcile(self.engine)
+
+    def iter_users(self, after=None, limit=100, gender=None, gender_search=None, birthday_from=None, birthday_to=None):
+        # Keyset-пагинация по первичному ключу: WHERE uuid > :after ORDER BY uuid LIMIT n, без OFFSET.
+        # Строки читаются серверным курсором (stream_results) и отдаются по одной
+        users = User.__table__
+        query = select(users).order_by(users.c.uuid).limit(limit)
+        if after is not None:
+            query = query.where(users.c.uuid > after)
+        if gender is not None:
+            query = query.where(users.c.gender == gender)
+        if gender_search is not None:
+            query = query.where(users.c.gender_search == gender_search)
+        if birthday_from is not None:
+            query = query.where(users.c.birthday >= birthday_from)
+        if birthday_to is not None:
+            query = query.where(users.c.birthday <= birthday_to)
+        with self.read_connection().engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(query)
+            for row in result:
+                yield user_to_dict(row)
+
+    def adjust_balance(self, uuid, delta, non_negative=False, idempotency_key=None):
+        # Атомарно: UPDATE users SET balance = balance + :delta, без чтения-изменения-записи через ORM.
+        # Возвращает (новый баланс, применено ли изменение). Повтор с тем же idempotency_key - applied False,
+        # тот же ключ с другим uuid или delta - IdempotencyKeyConflictException
+        users = User.__table__
+        adjustments = BalanceAdjustment.__table__
+        try:
+            with self.engine.begin() as connection:
+                if idempotency_key is not None:
+                    try:
+                        with connection.begin_nested():
+                            connection.execute(adjustments.insert().values(
+                                idempotency_key=idempotency_key, uuid=uuid, delta=delta
+                            ))
+                    except exc.IntegrityError:
+                        recorded = connection.execute(
+                            select(adjustments.c.uuid, adjustments.c.delta)
+                            .where(adjustments.c.idempotency_key == idempotency_key)
+                        ).first()
+                        if recorded is not None and (recorded.uuid, recorded.delta) != (uuid_lib.UUID(str(uuid)), delta):
+                            raise IdempotencyKeyConflictException([idempotency_key])
+                        balance = connection.execute(select(users.c.balance).where(users.c.uuid == uuid)).scalar()
+                        if balance is None:
+                            raise UserNotFoundException('User not found')
+                        return balance, False
+
+                query = update(users).where(users.c.uuid == uuid).values(balance=users.c.balance + delta)
+                if non_negative:
+                    query = query.where(users.c.balance + delta >= 0)
+                if connection.execute(query).rowcount == 0:
+                    # Исключение внутри begin() откатывает и запись в журнале
+                    if non_negative and connection.execute(select(users.c.uuid).where(users.c.uuid == uuid)).first():
+                        raise InsufficientBalanceException([uuid])
+                    raise UserNotFoundException('User not found')
+                user = connection.execute(
+                    select(users.c.balance, users.c.gender, users.c.gender_search, users.c.birthday)
+                    .where(users.c.uuid == uuid)
+                ).first()
+                deltas = dict()
+                stats.add_delta(deltas, stats.stats_key(user.gender, user.gender_search, user.birthday), 0, delta)
+                stats.apply_deltas(connection, deltas)
+        except (exc.DataError, exc.OperationalError, OverflowError) as e:
+            # Баланс или delta не влезают в INT колонки (MySQL: Out of range value / BIGINT value is out of range)
+            logger.error(e)
+            raise BalanceOutOfRangeException([uuid])
+        self.invalidate_user(uuid)
+        return user.balance, True
+
+    def adjust_balances(self, adjustments, non_negative=False):
+        # Пачка изменений [{'uuid', 'delta', 'idempotency_key'}] одной транзакцией.
+        # Дельты одного пользователя складываются и применяются одним UPDATE.
+        # Если хоть одно изменение нельзя применить, откатывается вся пачка
+        users = User.__table__
+        journal = BalanceAdjustment.__table__
+        # Ключ, уже записанный с другим uuid или delta (в журнале или раньше в этой же пачке), - конфликт всей пачки
+        unique = dict()  # idempotency_key -> изменение, повторы внутри пачки считаем один раз
+        without_key = []
+        conflicts = set()
+
+        def signature(uuid, delta):
+            return uuid_lib.UUID(str(uuid)), delta
+
+        for adjustment in adjustments:
+            key = adjustment.get('idempotency_key')
+            if key is None:
+                without_key.append(adjustment)
+                continue
+            first = unique.setdefault(key, adjustment)
+            if signature(first['uuid'], first['delta']) != signature(adjustment['uuid'], adjustment['delta']):
+                conflicts.add(key)
+
+        try:
+            with self.engine.begin() as connection:
+                duplicates = set()
+                keys = list(unique)
+                for start in range(0, len(keys), 1000):
+                    chunk = keys[start:start + 1000]
+                    for recorded in connection.execute(
+                        select(journal.c.idempotency_key, journal.c.uuid, journal.c.delta)
+                        .where(journal.c.idempotency_key.in_(chunk))
+                    ):
+                        duplicates.add(recorded.idempotency_key)
+                        requested = unique[recorded.idempotency_key]
+                        if (recorded.uuid, recorded.delta) != signature(requested['uuid'], requested['delta']):
+                            conflicts.add(recorded.idempotency_key)
+                if conflicts:
+                    raise IdempotencyKeyConflictException(sorted(conflicts))
+                new = [adjustment for key, adjustment in unique.items() if key not in duplicates] + without_key
+                rows = [{'idempotency_key': adjustment['idempotency_key'], 'uuid': adjustment['uuid'],
+                         'delta': adjustment['delta']} for adjustment in new if adjustment.get('idempotency_key') is not None]
+                if rows:
+                    # Конкурентная пачка с теми же ключами упадет здесь на первичном ключе журнала
+                    connection.execute(journal.insert(), rows)
+
+                totals = dict()
+                for adjustment in new:
+                    key = uuid_lib.UUID(str(adjustment['uuid']))
+                    totals[key] = totals.get(key, 0) + adjustment['delta']
+
+                not_found = []
+                insufficient = []
+                # Одинаковый порядок блокировок строк у всех пачек, чтоб не ловить дедлоки
+                for uuid in sorted(totals):
+                    query = update(users).where(users.c.uuid == uuid).values(balance=users.c.balance + totals[uuid])
+                    if non_negative:
+                        query = query.where(users.c.balance + totals[uuid] >= 0)
+                    if connection.execute(query).rowcount == 0:
+                        if non_negative and connection.execute(select(users.c.uuid).where(users.c.uuid == uuid)).first():
+                            insufficient.append(uuid)
+                        else:
+                            not_found.append(uuid)
+                if not_found:
+                    raise UserNotFoundException(f'User not found: {", ".join(str(uuid) for uuid in not_found)}')
+                if insufficient:
+                    raise InsufficientBalanceException(insufficient)
+
+                balances = dict()
+                deltas = dict()
+                uuids = list(totals)
+                for start in range(0, len(uuids), 1000):
+                    for user in connection.execute(
+                        select(users.c.uuid, users.c.balance, users.c.gender, users.c.gender_search, users.c.birthday)
+                        .where(users.c.uuid.in_(uuids[start:start + 1000]))
+                    ):
+                        balances[user.uuid] = user.balance
+                        stats.add_delta(deltas, stats.stats_key(user.gender, user.gender_search, user.birthday),
+                                        0, totals[user.uuid])
+                stats.apply_deltas(connection, deltas)
+        except (exc.DataError, exc.OperationalError, OverflowError) as e:
+            # Баланс или delta не влезают в INT колонки (MySQL: Out of range value / BIGINT value is out of range)
+            logger.error(e)
+            raise BalanceOutOfRangeException(list(dict.fromkeys(str(adjustment['uuid']) for adjustment in adjustments)))
+        for uuid in totals:
+            self.invalidate_user(uuid)
+        return {'applied': len(new), 'duplicates': sorted(duplicates),
+                'balances': {str(uuid): balance for uuid, balance in balances.items()}}
+
     def edit_user_info(self, uuid, new_username=None, new_email=None, new_phone=None, new_gender=None, new_gender_search=None, new_balance=None, new_birthday=None):
-        user = self.mysql_connection.session.query(User).filter_by(uuid=uuid).first()
-        #logger.info(f'new_phone: {new_phone}')
-        if user:
-            if new_username is not None and new_username != '':
-                user.username = new_username
-            elif new_email is not None:
-                user.email = new_email
-            elif new_phone is not None:
-                #logger.info(f'new_phone: {new_phone}')
-                user.phone = new_phone
-            elif new_gender is not None:
-                user.gender = new_gender
-            elif new_gender_search is not None:
-                user.gender_search = new_gender_search
-            elif new_balance is not None:
-                user.balance = new_balance
-            elif new_birthday is not None:
-                user.birthday = new_birthday
+        # Все переданные поля пишутся одним UPDATE users SET ... WHERE uuid = :uuid.
+        # Занятые username/email/phone отсекает уникальный ключ, отсутствие пользователя - rowcount 0.
+        # Если меняются gender, gender_search, birthday или balance, в той же транзакции правится user_stats.
+        # Возвращает uuid и новые значения измененных полей, без повторного select
+        changes = {
+            'username': new_username,
+            'email': new_email,
+            'phone': new_phone,
+            'gender': new_gender,
+            'gender_search': new_gender_search,
+            'balance': new_balance,
+            'birthday': new_birthday
+        }
+        changes = {column: value for column, value in changes.items() if value is not None}
+        if not changes:
             return self.get_user_info(uuid)
-#            return self.get_user_info(username if new_username is None else new_username)
-        else:
+
+        users = User.__table__
+
+        def edit(connection):
+            if not changes.keys() & {'gender', 'gender_search', 'birthday', 'balance'}:
+                return connection.execute(update(users).where(users.c.uuid == uuid).values(**changes)).rowcount
+            # Меняются поля из агрегатов /stats: старые значения нужны, чтоб перенести пользователя между группами
+            old = connection.execute(
+                select(users.c.gender, users.c.gender_search, users.c.birthday, users.c.balance)
+                .where(users.c.uuid == uuid).with_for_update()
+            ).first()
+            if old is None:
+                return 0
+            rowcount = connection.execute(update(users).where(users.c.uuid == uuid).values(**changes)).rowcount
+            new = {**old._mapping, **changes}
+            deltas = dict()
+            stats.add_delta(deltas, stats.stats_key(old.gender, old.gender_search, old.birthday), -1, -old.balance)
+            stats.add_delta(deltas, stats.stats_key(new['gender'], new['gender_search'], new['birthday']),
+                            1, new['balance'])
+            stats.apply_deltas(connection, deltas)
+            return rowcount
+
+        try:
+            rowcount = self.write(edit)
+        except exc.IntegrityError as e:
+            field = conflict_field(e)
+            if field is None:
+                logger.error(e)
+                raise OperationalErrorException('Bad request. Check types for parameters.')
+            raise UserAlreadyExistsException(field)
+        except (exc.OperationalError, exc.StatementError) as e:
+            logger.error(e)
+            raise OperationalErrorException('Bad request. Check types for parameters.')
+        if rowcount == 0:
             raise UserNotFoundException('User not found')
+        self.invalidate_user(uuid)
+        # Ключи как в get_user_info
+        return {'uuid': uuid_lib.UUID(str(uuid)),
+                **{'Gender' if column == 'gender' else column: value for column, value in changes.items()}}
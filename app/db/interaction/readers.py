@@ -0,0 +1,55 @@
+from sqlalchemy import bindparam, literal_column, select
+
+from app.db.models.models import User
+
+# Два взаимозаменяемых способа читать пользователей для DBInteraction.
+# OrmUserReader - прежний путь через session.query(User), собирает полноценные объекты User.
+# CoreUserReader - заранее построенные select по нужным колонкам, строки без гидрации ORM,
+# проверки существования как SELECT 1 ... LIMIT 1. Скомпилированный SQL SQLAlchemy кэширует по самому запросу
+
+users = User.__table__
+USER_COLUMNS = [users.c.uuid, users.c.username, users.c.email, users.c.phone, users.c.gender,
+                users.c.gender_search, users.c.balance, users.c.birthday]
+
+SELECT_USER_BY_UUID = select(*USER_COLUMNS).where(users.c.uuid == bindparam('uuid')).limit(1)
+# Список uuid разворачивается в IN (...) при выполнении, сам запрос строится один раз
+SELECT_USERS_BY_UUIDS = select(*USER_COLUMNS).where(users.c.uuid.in_(bindparam('uuids', expanding=True)))
+EXISTS_BY = {
+    column: select(literal_column('1')).select_from(users).where(users.c[column] == bindparam('value')).limit(1)
+    for column in ('uuid', 'username', 'email', 'phone')
+}
+
+
+class OrmUserReader:
+    def __init__(self, mysql_connection):
+        self.mysql_connection = mysql_connection
+
+    def exists(self, column, value):
+        return self.mysql_connection.session.query(User).filter_by(**{column: value}).first() is not None
+
+    def get_user(self, uuid):
+        # populate_existing вместо expire_all: обновляем только этот объект
+        return self.mysql_connection.session.query(User).populate_existing().filter_by(uuid=uuid).first()
+
+    def get_users(self, uuids):
+        return self.mysql_connection.session.query(User).populate_existing().filter(User.uuid.in_(uuids)).all()
+
+
+class CoreUserReader:
+    def __init__(self, mysql_connection):
+        self.mysql_connection = mysql_connection
+
+    def exists(self, column, value):
+        return self.mysql_connection.session.execute(EXISTS_BY[column], {'value': value}).first() is not None
+
+    def get_user(self, uuid):
+        return self.mysql_connection.session.execute(SELECT_USER_BY_UUID, {'uuid': uuid}).first()
+
+    def get_users(self, uuids):
+        return self.mysql_connection.session.execute(SELECT_USERS_BY_UUIDS, {'uuids': uuids}).all()
+
+
+READERS = {
+    'orm': OrmUserReader,
+    'core': CoreUserReader
+}
@@ -0,0 +1,211 @@
+import datetime
+import random
+import threading
+import time
+
+from loguru import logger
+from sqlalchemy import exc, extract, func, select, text, update
+from sqlalchemy.dialects import mysql, sqlite
+
+from app.db.models.models import JobRun, User, UserStats
+
+# Инкрементальные агрегаты по пользователям для /stats: число пользователей и сумма балансов
+# по (gender, gender_search, год рождения). Каждая запись в users меняет их в своей же транзакции,
+# так что /stats читает несколько десятков строк вместо GROUP BY по всей таблице.
+# Сверка с полным пересчетом (reconcile) исправляет расхождения, например от записей в обход DBInteraction
+
+users = User.__table__
+user_stats = UserStats.__table__
+job_runs = JobRun.__table__
+STATS_SLOTS = 8
+RECONCILE_LOCK = 'api_server_user_stats_reconcile'
+
+
+def stats_key(gender, gender_search, birthday):
+    return gender, gender_search, birthday.year
+
+
+def add_delta(deltas, key, users_delta, balance_delta):
+    # deltas: {ключ: [изменение числа пользователей, изменение суммы балансов]}
+    delta = deltas.setdefault(key, [0, 0])
+    delta[0] += users_delta
+    delta[1] += balance_delta
+
+
+def upsert(connection, values):
+    # Прибавить users и balance_sum к строке ключа, создав ее при необходимости
+    if connection.dialect.name == 'mysql':
+        query = mysql.insert(user_stats).values(**values)
+        connection.execute(query.on_duplicate_key_update(
+            users=user_stats.c.users + query.inserted.users,
+            balance_sum=user_stats.c.balance_sum + query.inserted.balance_sum
+        ))
+    elif connection.dialect.name == 'sqlite':
+        query = sqlite.insert(user_stats).values(**values)
+        connection.execute(query.on_conflict_do_update(
+            index_elements=[user_stats.c.gender, user_stats.c.gender_search, user_stats.c.birth_year, user_stats.c.slot],
+            set_={'users': user_stats.c.users + query.excluded.users,
+                  'balance_sum': user_stats.c.balance_sum + query.excluded.balance_sum}
+        ))
+    else:
+        result = connection.execute(update(user_stats).where(
+            user_stats.c.gender == values['gender'],
+            user_stats.c.gender_search == values['gender_search'],
+            user_stats.c.birth_year == values['birth_year'],
+            user_stats.c.slot == values['slot']
+        ).values(users=user_stats.c.users + values['users'],
+                 balance_sum=user_stats.c.balance_sum + values['balance_sum']))
+        if result.rowcount == 0:
+            connection.execute(user_stats.insert().values(**values))
+
+
+def apply_deltas(connection, deltas, slot=None):
+    # Вызывается внутри транзакции, которая меняет users. Ключи по порядку: одинаковый порядок блокировок
+    if slot is None:
+        slot = random.randrange(STATS_SLOTS)
+    for (gender, gender_search, birth_year), (users_delta, balance_delta) in sorted(deltas.items()):
+        if users_delta == 0 and balance_delta == 0:
+            continue
+        upsert(connection, {'gender': gender, 'gender_search': gender_search, 'birth_year': birth_year,
+                            'slot': slot, 'users': users_delta, 'balance_sum': balance_delta})
+
+
+def recount(connection):
+    # Полный пересчет по users: {ключ: [пользователи, сумма балансов]}
+    birth_year = extract('year', users.c.birthday)
+    rows = connection.execute(
+        select(users.c.gender, users.c.gender_search, birth_year, func.count(), func.coalesce(func.sum(users.c.balance), 0))
+        .group_by(users.c.gender, users.c.gender_search, birth_year)
+    )
+    return {(gender, gender_search, int(year)): [int(count), int(balance)]
+            for gender, gender_search, year, count, balance in rows}
+
+
+def stored(connection):
+    # То, что сейчас в user_stats, со всеми шардами вместе
+    rows = connection.execute(
+        select(user_stats.c.gender, user_stats.c.gender_search, user_stats.c.birth_year,
+               func.sum(user_stats.c.users), func.sum(user_stats.c.balance_sum))
+        .group_by(user_stats.c.gender, user_stats.c.gender_search, user_stats.c.birth_year)
+    )
+    return {(gender, gender_search, int(year)): [int(count), int(balance)]
+            for gender, gender_search, year, count, balance in rows}
+
+
+def create_job_runs(connection):
+    job_runs.create(connection, checkfirst=True)
+
+
+def ran_recently(connection, min_interval):
+    last_run = connection.execute(select(job_runs.c.last_run).where(job_runs.c.name == RECONCILE_LOCK)).scalar()
+    # Запас в 10%: воркер, сам сделавший прошлую сверку, просыпается ровно через interval и не должен ее пропустить
+    return last_run is not None and \
+        datetime.datetime.utcnow() - last_run < datetime.timedelta(seconds=min_interval * 0.9)
+
+
+def record_run(connection):
+    now = datetime.datetime.utcnow()
+    if connection.execute(update(job_runs).where(job_runs.c.name == RECONCILE_LOCK).values(last_run=now)).rowcount:
+        return
+    try:
+        connection.execute(job_runs.insert().values(name=RECONCILE_LOCK, last_run=now))
+    except exc.IntegrityError:
+        pass  # Первую отметку одновременно вставил другой процесс (без GET_LOCK, не MySQL)
+
+
+def create_user_stats(connection):
+    # Миграция схемы: таблица и первое заполнение по уже существующим пользователям
+    user_stats.create(connection, checkfirst=True)
+    apply_deltas(connection, recount(connection), slot=0)
+
+
+def reconcile(engine, min_interval=None):
+    # Пересчет и сохраненные агрегаты читаются в одном снимке (обе таблицы меняются одной транзакцией),
+    # поэтому их разница - точное расхождение. Применяем его прибавлением: записи, которые прошли
+    # после снимка, не теряются. Возвращает {ключ: поправка}.
+    # min_interval: не сверять, если любой процесс уже сверял меньше min_interval секунд назад (job_runs),
+    # тогда возвращает None. Так полный пересчет идет раз в интервал на всю базу, а не на каждый воркер
+    with engine.connect() as connection:
+        if connection.dialect.name == 'mysql':
+            # Две сверки одновременно применили бы одну поправку дважды
+            if connection.execute(text('SELECT GET_LOCK(:name, 0)'), {'name': RECONCILE_LOCK}).scalar() != 1:
+                return None
+            connection = connection.execution_options(isolation_level='REPEATABLE READ')
+        try:
+            if min_interval is not None and ran_recently(connection, min_interval):
+                return None
+            with connection.begin():
+                actual = recount(connection)
+                current = stored(connection)
+            drift = dict()
+            for key in set(actual) | set(current):
+                users_delta = actual.get(key, [0, 0])[0] - current.get(key, [0, 0])[0]
+                balance_delta = actual.get(key, [0, 0])[1] - current.get(key, [0, 0])[1]
+                if users_delta or balance_delta:
+                    drift[key] = [users_delta, balance_delta]
+            with connection.begin():
+                if drift:
+                    apply_deltas(connection, drift, slot=0)
+                record_run(connection)
+            if drift:
+                logger.warning(f'user_stats reconciled, {len(drift)} groups corrected: {drift}')
+            return drift
+        finally:
+            if connection.dialect.name == 'mysql':
+                connection.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': RECONCILE_LOCK})
+
+
+def summarize(connection, cohort_years=10):
+    # Ответ /stats: читается не больше (полов * полов * лет * STATS_SLOTS) строк, от размера users не зависит
+    groups = stored(connection)
+    total_users = sum(count for count, _ in groups.values())
+    total_balance = sum(balance for _, balance in groups.values())
+    genders = dict()
+    cohorts = dict()
+    for (gender, gender_search, birth_year), (count, _) in groups.items():
+        if count == 0:
+            continue
+        genders[(gender, gender_search)] = genders.get((gender, gender_search), 0) + count
+        start = birth_year - birth_year % cohort_years
+        cohorts[start] = cohorts.get(start, 0) + count
+    return {
+        'users': total_users,
+        'balance': {'total': total_balance, 'average': total_balance / total_users if total_users else None},
+        'genders': [{'gender': gender, 'gender_search': gender_search, 'users': count}
+                    for (gender, gender_search), count in sorted(genders.items())],
+        'birthday_cohorts': [{'from': start, 'to': start + cohort_years - 1, 'users': count}
+                             for start, count in sorted(cohorts.items())]
+    }
+
+
+class StatsReconciler:
+    # Периодическая сверка в фоновом потоке. Как и проверки реплик, останавливается перед fork.
+    # Поток есть в каждом воркере, но сверяет только тот, кто первым проснулся после интервала
+    def __init__(self, engine_getter, interval):
+        self.engine_getter = engine_getter
+        self.interval = interval
+        self.last_run = None  # Время последней сверки, сделанной этим процессом (unix time)
+        self.last_drift = None  # Сколько групп она исправила
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                drift = reconcile(self.engine_getter(), min_interval=self.interval)
+                if drift is not None:
+                    self.last_drift = len(drift)
+                    self.last_run = time.time()
+            except Exception as e:
+                logger.error(f'user_stats reconcile failed: {e}')
+
+    def start(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='user-stats-reconcile', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
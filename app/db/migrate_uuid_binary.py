@@ -0,0 +1,136 @@
+import argparse
+import time
+
+from loguru import logger
+from sqlalchemy import text
+
+from app.api.utils import config_parser
+from app.db.client.client import MySQLConnection
+
+# Перевод существующей таблицы users с CHAR(32) uuid на BINARY(16).
+# 1. Добавляем колонку uuid_bin и триггеры, которые заполняют ее для новых и измененных строк
+# 2. Заполняем uuid_bin у старых строк пачками по chunk-size, каждая пачка - своя короткая транзакция
+# 3. Под LOCK TABLES users WRITE дозаполняем uuid_bin, снимаем триггеры и одним ALTER меняем первичный ключ
+#    на uuid_bin с переименованием в uuid (перестроение таблицы). Записи ждут блокировку, а не теряются
+# Порядок выкатки, без окна, где с таблицей работает несовместимая версия:
+#   python -m app.db.migrate_uuid_binary --config=./app/api/config.txt --chunk-size=5000
+#       шаги 1-2, старый сервер работает как обычно (долгая часть, зависит от размера таблицы)
+#   остановить старый сервер (он пишет в uuid 32 символа и после шага 3 не найдет ни одной строки)
+#   python -m app.db.migrate_uuid_binary --config=./app/api/config.txt --swap
+#       шаг 3, откажется, пока к базе подключен кто-то еще (--force - не проверять)
+#   запустить новый сервер: пока uuid CHAR(32), он сам не стартует (app.db.schema.check_uuid_binary)
+
+
+def column_type(connection, db_name, column):
+    return connection.execute(text(
+        'SELECT DATA_TYPE FROM information_schema.COLUMNS '
+        'WHERE TABLE_SCHEMA = :db AND TABLE_NAME = \'users\' AND COLUMN_NAME = :column'
+    ), {'db': db_name, 'column': column}).scalar()
+
+
+def prepare(engine, db_name):
+    with engine.begin() as connection:
+        if column_type(connection, db_name, 'uuid_bin') is None:
+            connection.execute(text('ALTER TABLE users ADD COLUMN uuid_bin BINARY(16) NULL'))
+        connection.execute(text('DROP TRIGGER IF EXISTS users_uuid_bin_insert'))
+        connection.execute(text('DROP TRIGGER IF EXISTS users_uuid_bin_update'))
+        connection.execute(text(
+            'CREATE TRIGGER users_uuid_bin_insert BEFORE INSERT ON users '
+            'FOR EACH ROW SET NEW.uuid_bin = UNHEX(NEW.uuid)'
+        ))
+        connection.execute(text(
+            'CREATE TRIGGER users_uuid_bin_update BEFORE UPDATE ON users '
+            'FOR EACH ROW SET NEW.uuid_bin = UNHEX(NEW.uuid)'
+        ))
+
+
+def backfill(engine, chunk_size, pause):
+    total = 0
+    while True:
+        started = time.perf_counter()
+        with engine.begin() as connection:
+            updated = connection.execute(text(
+                'UPDATE users SET uuid_bin = UNHEX(uuid) WHERE uuid_bin IS NULL LIMIT :chunk'
+            ), {'chunk': chunk_size}).rowcount
+        total += updated
+        logger.info(f'uuid_bin backfill: {updated} rows in {time.perf_counter() - started:.3f}s, total {total}')
+        if updated < chunk_size:
+            return total
+        time.sleep(pause)  # Даем репликам и рабочей нагрузке продохнуть между пачками
+
+
+def other_clients(connection, db_name):
+    # Соединения с этой базой, кроме нашего: старый сервер, который надо остановить перед шагом 3
+    return connection.execute(text(
+        'SELECT ID, USER, HOST FROM information_schema.PROCESSLIST '
+        'WHERE DB = :db AND ID != CONNECTION_ID()'
+    ), {'db': db_name}).all()
+
+
+def swap(engine):
+    # LOCK TABLES неявно коммитит и живет до UNLOCK TABLES на том же соединении, поэтому без engine.begin()
+    with engine.connect() as connection:
+        connection = connection.execution_options(autocommit=True)
+        connection.execute(text('LOCK TABLES users WRITE'))
+        try:
+            # Триггеры снимаем уже под блокировкой: строк без uuid_bin после этого UPDATE не появится
+            connection.execute(text('UPDATE users SET uuid_bin = UNHEX(uuid) WHERE uuid_bin IS NULL'))
+            connection.execute(text('DROP TRIGGER IF EXISTS users_uuid_bin_insert'))
+            connection.execute(text('DROP TRIGGER IF EXISTS users_uuid_bin_update'))
+            connection.execute(text(
+                'ALTER TABLE users '
+                'DROP PRIMARY KEY, '
+                'DROP COLUMN uuid, '
+                'CHANGE COLUMN uuid_bin uuid BINARY(16) NOT NULL FIRST, '
+                'ADD PRIMARY KEY (uuid)'
+            ))
+        finally:
+            connection.execute(text('UNLOCK TABLES'))
+
+
+def migrate(mysql_connection, chunk_size=5000, pause=0.05, do_swap=False, force=False):
+    # Без do_swap - шаги 1-2 при работающем старом сервере, с do_swap - шаг 3 после его остановки
+    engine = mysql_connection.engine
+    with engine.connect() as connection:
+        current_type = column_type(connection, mysql_connection.db_name, 'uuid')
+        clients = other_clients(connection, mysql_connection.db_name) if do_swap and not force else []
+    if current_type == 'binary':
+        logger.info('users.uuid is already BINARY(16), nothing to do')
+        return 0
+    if clients:
+        raise RuntimeError(f'{len(clients)} other connections to {mysql_connection.db_name} '
+                           f'({", ".join(f"{row.USER}@{row.HOST}" for row in clients[:5])}): '
+                           f'stop the old server before --swap or pass --force')
+    prepare(engine, mysql_connection.db_name)
+    total = backfill(engine, chunk_size, pause)
+    if not do_swap:
+        logger.info(f'uuid_bin backfilled, {total} rows: stop the old server and run again with --swap')
+        return total
+    swap(engine)
+    logger.info(f'users.uuid migrated to BINARY(16), {total} rows converted during swap')
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, dest='config')
+    parser.add_argument('--chunk-size', type=int, dest='chunk_size', default=5000)
+    parser.add_argument('--pause', type=float, dest='pause', default=0.05)
+    parser.add_argument('--swap', action='store_true', dest='swap', help='шаг 3, старый сервер уже остановлен')
+    parser.add_argument('--force', action='store_true', dest='force', help='не проверять чужие соединения')
+    args = parser.parse_args()
+    config = config_parser(args.config)
+
+    mysql_connection = MySQLConnection(
+        host=config['DB_HOST'],
+        port=config['DB_PORT'],
+        user=config['DB_USER'],
+        password=config['DB_PASSWORD'],
+        db_name=config['DB_NAME']
+    )
+    migrate(mysql_connection, chunk_size=args.chunk_size, pause=args.pause, do_swap=args.swap, force=args.force)
+    mysql_connection.dispose()
+
+
+if __name__ == '__main__':
+    main()
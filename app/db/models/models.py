@@ -1,8 +1,10 @@
-from sqlalchemy import Column, Integer, ForeignKey, VARCHAR, UniqueConstraint, INT, SMALLINT, DATE
+from sqlalchemy import Column, Integer, ForeignKey, VARCHAR, UniqueConstraint, Index, INT, SMALLINT, BIGINT, DATE, \
+    DATETIME
 from sqlalchemy.ext.declarative import declarative_base  # База объектов, из которой будем импортировать все наши модели
 from sqlalchemy.orm import relationship
 from sqlalchemy_utils import UUIDType
 import uuid
+import datetime
 
 Base = declarative_base()
 
@@ -11,8 +13,18 @@ Base = declarative_base()
 
 class User(Base):
     __tablename__ = 'users'
+    # Имена уникальных ключей совпадают с именами колонок: по ним DBInteraction понимает, какое поле занято
+    __table_args__ = (
+        UniqueConstraint('username', name='username'),
+        UniqueConstraint('email', name='email'),
+        UniqueConstraint('phone', name='phone'),
+        # Для выборок по полу, кого ищем и дате рождения (в т.ч. фильтры /users)
+        Index('ix_users_gender_gender_search_birthday', 'gender', 'gender_search', 'birthday'),
+    )
 
-    uuid = Column(UUIDType(binary=False), primary_key=True)
+    # BINARY(16) вместо CHAR(32): ключ и ссылки на него во вторичных индексах вдвое короче.
+    # Для API ничего не меняется, UUIDType сам переводит строку в байты и обратно
+    uuid = Column(UUIDType(binary=True), primary_key=True)
     username = Column(VARCHAR(50), nullable=True, default=None)
     email = Column(VARCHAR(40), nullable=True, default=None)
     phone = Column(VARCHAR(20), nullable=True, default=None)
@@ -21,9 +33,45 @@ class User(Base):
     balance = Column(INT, default=0, nullable=False)
     birthday = Column(DATE, nullable=False)
 
-    UniqueConstraint(uuid, name='uuid')
-    UniqueConstraint(email, name='email')
-    UniqueConstraint(phone, name='phone')
+
+class BalanceAdjustment(Base):
+    # Журнал примененных изменений баланса: повтор запроса с тем же idempotency_key ничего не меняет
+    __tablename__ = 'balance_adjustments'
+
+    idempotency_key = Column(VARCHAR(64), primary_key=True)
+    uuid = Column(UUIDType(binary=True), nullable=False)
+    delta = Column(INT, nullable=False)
+    created_at = Column(DATETIME, nullable=False, default=datetime.datetime.utcnow)
+
+
+class UserStats(Base):
+    # Агрегаты для /stats, меняются в той же транзакции, что и users (app/db/interaction/stats.py).
+    # slot - номер шарда счетчика: параллельные записи обновляют разные строки одной группы и не ждут друг друга
+    __tablename__ = 'user_stats'
+
+    gender = Column(VARCHAR(10), primary_key=True)
+    gender_search = Column(VARCHAR(10), primary_key=True)
+    birth_year = Column(SMALLINT, primary_key=True, autoincrement=False)
+    slot = Column(SMALLINT, primary_key=True, autoincrement=False)
+    users = Column(BIGINT, nullable=False, default=0)
+    balance_sum = Column(BIGINT, nullable=False, default=0)
+
+
+class JobRun(Base):
+    # Когда периодическая задача последний раз выполнялась где-либо: воркеры и машины не повторяют ее друг за другом
+    __tablename__ = 'job_runs'
+
+    name = Column(VARCHAR(64), primary_key=True)
+    last_run = Column(DATETIME, nullable=False)
+
+
+class SchemaVersion(Base):
+    # Примененные миграции схемы (app/db/schema.py), по строке на версию
+    __tablename__ = 'schema_version'
+
+    version = Column(INT, primary_key=True, autoincrement=False)
+    description = Column(VARCHAR(200), nullable=False)
+    applied_at = Column(DATETIME, nullable=False, default=datetime.datetime.utcnow)
 
 # class MusicalComposition(Base):
 #    __tablename__ = 'musical_compositions'
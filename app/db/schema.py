@@ -0,0 +1,164 @@
+import argparse
+import time
+
+from loguru import logger
+from sqlalchemy import String, UniqueConstraint, func, inspect, select, text
+
+from app.api.utils import config_parser
+from app.db.client.client import MySQLConnection
+from app.db.exceptions import SchemaMigrationException
+from app.db.interaction.stats import create_job_runs, create_user_stats
+from app.db.models.models import Base, SchemaVersion, User
+
+# Версионирование схемы вместо пересоздания таблиц на каждом старте.
+# В schema_version лежат примененные версии, на старте применяются только недостающие миграции.
+# Если схема актуальна, это один SELECT. Миграции можно накатить и отдельно от сервера (DB_MIGRATE = 0 в конфиге):
+#   python -m app.db.schema --config=./app/api/config.txt
+#   python -m app.db.schema --config=./app/api/config.txt --status
+
+schema_versions = SchemaVersion.__table__
+users = User.__table__
+MIGRATION_LOCK = 'api_server_schema_migration'
+
+
+def check_uuid_binary(connection):
+    # Таблица users старой версии хранит uuid в CHAR(32), а модель пишет и ищет 16 байт: ни один uuid бы не нашелся
+    if not inspect(connection).has_table('users'):
+        return
+    for column in inspect(connection).get_columns('users'):
+        if column['name'] == 'uuid' and isinstance(column['type'], String):
+            raise SchemaMigrationException(
+                f'users.uuid is {column["type"]}, not BINARY(16): convert it first with '
+                f'python -m app.db.migrate_uuid_binary --config=...'
+            )
+
+
+def create_base_tables(connection):
+    # Базы, созданные до версионирования, уже содержат эти таблицы: checkfirst их не трогает,
+    # недостающие ключи и индексы users добавляет миграция 3
+    check_uuid_binary(connection)
+    Base.metadata.create_all(connection, tables=[Base.metadata.tables['users'],
+                                                 Base.metadata.tables['balance_adjustments']])
+
+
+def adopt_users_table(connection):
+    # Таблица users, созданная до версионирования, не имеет уникальных ключей username/email/phone
+    # (без них optimistic insert молча пропускает дубли) и составного индекса для фильтров /users
+    check_uuid_binary(connection)
+    inspector = inspect(connection)
+    existing = {index['name'] for index in inspector.get_indexes('users')}
+    existing |= {constraint['name'] for constraint in inspector.get_unique_constraints('users')}
+    quote = connection.dialect.identifier_preparer.quote
+    for constraint in users.constraints:
+        if not isinstance(constraint, UniqueConstraint) or constraint.name in existing:
+            continue
+        columns = [column.name for column in constraint.columns]
+        duplicates = connection.execute(
+            select(*constraint.columns).where(*(column.isnot(None) for column in constraint.columns))
+            .group_by(*constraint.columns).having(func.count() > 1).limit(5)
+        ).all()
+        if duplicates:
+            raise SchemaMigrationException(f'users has duplicate {", ".join(columns)} values '
+                                           f'{[tuple(row) for row in duplicates]}, resolve them before upgrading')
+        # Уникальный индекс и в MySQL, и в SQLite (там нет ADD CONSTRAINT); имя ключа - имя колонки, как в модели
+        connection.execute(text(f'CREATE UNIQUE INDEX {quote(constraint.name)} ON users '
+                                f'({", ".join(quote(column) for column in columns)})'))
+        logger.info(f'users: unique key {constraint.name} added')
+    for index in users.indexes:
+        if index.name not in existing:
+            index.create(connection)
+            logger.info(f'users: index {index.name} added')
+
+
+# (версия, описание, функция от connection). Новые миграции только дописываются в конец, старые не меняются
+MIGRATIONS = [
+    (1, 'users and balance_adjustments', create_base_tables),
+    (2, 'user_stats aggregates', create_user_stats),
+    (3, 'users keys for tables created before versioning', adopt_users_table),
+    (4, 'job_runs', create_job_runs),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    if not inspect(connection).has_table(SchemaVersion.__tablename__):
+        return 0
+    return connection.execute(select(func.max(schema_versions.c.version))).scalar() or 0
+
+
+def acquire_lock(connection, timeout):
+    # Воркеры нескольких машин стартуют одновременно: мигрирует один, остальные ждут и видят готовую схему
+    if connection.dialect.name != 'mysql':
+        return
+    acquired = connection.execute(text('SELECT GET_LOCK(:name, :timeout)'),
+                                  {'name': MIGRATION_LOCK, 'timeout': timeout}).scalar()
+    if acquired != 1:
+        raise SchemaMigrationException(f'could not get schema migration lock in {timeout}s')
+
+
+def release_lock(connection):
+    if connection.dialect.name == 'mysql':
+        connection.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': MIGRATION_LOCK})
+
+
+def migrate(engine, lock_timeout=60):
+    # Применяет недостающие миграции, возвращает список примененных версий
+    with engine.connect() as connection:
+        version = current_version(connection)
+        if version >= LATEST_VERSION:
+            return []
+
+        acquire_lock(connection, lock_timeout)
+        try:
+            schema_versions.create(connection, checkfirst=True)
+            # Пока ждали блокировку, схему мог обновить другой процесс
+            version = current_version(connection)
+            applied = []
+            for migration_version, description, upgrade in MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                started = time.perf_counter()
+                with connection.begin():
+                    upgrade(connection)
+                    connection.execute(schema_versions.insert(),
+                                       {'version': migration_version, 'description': description})
+                logger.info(f'schema migration {migration_version} ({description}) applied '
+                            f'in {(time.perf_counter() - started) * 1000:.0f}ms')
+                applied.append(migration_version)
+            return applied
+        finally:
+            release_lock(connection)
+
+
+def reset(engine):
+    # Чистая база для разработки и тестов (rebuild_db): сносим все таблицы моделей вместе с версиями
+    Base.metadata.drop_all(engine)
+    logger.info('all tables dropped')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, dest='config')
+    parser.add_argument('--status', action='store_true', dest='status', help='только показать текущую версию')
+    args = parser.parse_args()
+    config = config_parser(args.config)
+
+    mysql_connection = MySQLConnection(
+        host=config['DB_HOST'],
+        port=config['DB_PORT'],
+        user=config['DB_USER'],
+        password=config['DB_PASSWORD'],
+        db_name=config['DB_NAME'],
+        url=config.get('DB_URL')
+    )
+    if args.status:
+        with mysql_connection.engine.connect() as connection:
+            print(f'schema version {current_version(connection)}, latest {LATEST_VERSION}')
+    else:
+        applied = migrate(mysql_connection.engine)
+        print(f'applied migrations: {applied}' if applied else 'schema is up to date')
+    mysql_connection.dispose()
+
+
+if __name__ == '__main__':
+    main()